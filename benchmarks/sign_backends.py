@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+
+# Compare the local signing backends on typical unoparty transactions:
+# P2PKH inputs, an OP_RETURN data output and a change output.
+#
+#   python3 benchmarks/sign_backends.py [--inputs 1] [--count 200] [--library /path/to/libsecp256k1.so]
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pycoin.tx import Tx, TxIn, TxOut, SIGHASH_ALL
+from pycoin.encoding import public_pair_to_hash160_sec
+from pycoin.ecdsa import generator_secp256k1, public_pair_for_secret_exponent
+
+from unopartycli import signing
+
+def make_transactions(count, inputs, hash160):
+    p2pkh_script = b'\x76\xa9\x14' + hash160 + b'\x88\xac'
+    op_return_script = b'\x6a\x1c' + os.urandom(28)
+    tx_hexes = []
+    for i in range(count):
+        txs_in = [TxIn(os.urandom(32), n, p2pkh_script) for n in range(inputs)]
+        txs_out = [TxOut(0, op_return_script), TxOut(100000 + i, p2pkh_script)]
+        tx_hexes.append(Tx(1, txs_in, txs_out).as_hex())
+    return tx_hexes
+
+def sign_all(backend, tx_hexes, hash160_lookup):
+    signing.backend = backend
+    signed_tx_hexes = []
+    start = time.time()
+    for tx_hex in tx_hexes:
+        tx = Tx.from_hex(tx_hex)
+        for idx in range(len(tx.txs_in)):
+            signing.sign_tx_in(tx, idx, hash160_lookup, SIGHASH_ALL)
+        signed_tx_hexes.append(tx.as_hex())
+    return time.time() - start, signed_tx_hexes
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the local signing backends')
+    parser.add_argument('--count', type=int, default=200, help='number of transactions to sign')
+    parser.add_argument('--inputs', type=int, default=1, help='number of inputs per transaction')
+    parser.add_argument('--library', help='path to libsecp256k1 (default: search the system)')
+    args = parser.parse_args()
+
+    secret_exponent = int.from_bytes(os.urandom(32), 'big') % signing.SECP256K1_ORDER
+    public_pair = public_pair_for_secret_exponent(generator_secp256k1, secret_exponent)
+    hash160 = public_pair_to_hash160_sec(public_pair, True)
+    hash160_lookup = {hash160: (secret_exponent, public_pair, True)}
+    tx_hexes = make_transactions(args.count, args.inputs, hash160)
+
+    backends = [signing.PycoinBackend()]
+    try:
+        backends.append(signing.Secp256k1Backend(args.library))
+    except signing.SigningBackendError as e:
+        print('Skipping libsecp256k1: {}'.format(e))
+
+    results = {}
+    for backend in backends:
+        elapsed, signed_tx_hexes = sign_all(backend, tx_hexes, hash160_lookup)
+        results[backend.name] = signed_tx_hexes
+        signatures = args.count * args.inputs
+        print('{:<14} {:>8.3f}s  {:>10.1f} signatures/s'.format(backend.name, elapsed, signatures / elapsed))
+
+    if len(results) > 1:
+        identical = results['pycoin'] == results['libsecp256k1']
+        print('Identical signatures: {}'.format('yes' if identical else 'NO'))
+        if not identical:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+
+# Measure the startup cost of `unoparty-client`: the import time of the client module,
+# as reported by `python -X importtime`, and the wall time of a bare import.
+#
+#   python3 benchmarks/startup.py [--runs 10] [--top 20] [--module unopartycli.client]
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def run_python(args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT_DIR] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    return subprocess.run([sys.executable] + args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+# Lines look like `import time:       self [us] |  cumulative | imported package`.
+def parse_importtime(stderr):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        imports.append((int(fields[0]), int(fields[1]), fields[2].rstrip()))
+    return imports
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup of the client')
+    parser.add_argument('--runs', type=int, default=10, help='number of timed imports')
+    parser.add_argument('--top', type=int, default=20, help='number of slowest imports listed')
+    parser.add_argument('--module', default='unopartycli.client', help='module to import')
+    args = parser.parse_args()
+
+    statement = 'import {}'.format(args.module)
+    imports = parse_importtime(run_python(['-X', 'importtime', '-c', statement]).stderr)
+    total = sum(self_us for self_us, cumulative_us, name in imports)
+    print('{} modules imported in {:.1f} ms'.format(len(imports), total / 1000))
+    print()
+    print('{:>10} {:>10}  {}'.format('self (ms)', 'cum. (ms)', 'module'))
+    for self_us, cumulative_us, name in sorted(imports, key=lambda i: i[1], reverse=True)[:args.top]:
+        print('{:>10.1f} {:>10.1f}  {}'.format(self_us / 1000, cumulative_us / 1000, name))
+
+    timings = []
+    for i in range(args.runs):
+        start = time.time()
+        run_python(['-c', statement])
+        timings.append(time.time() - start)
+    timings.sort()
+    print()
+    print('`python -c "{}"` over {} runs: min {:.3f}s, median {:.3f}s'.format(statement, args.runs, timings[0], timings[len(timings) // 2]))
+
+if __name__ == '__main__':
+    main()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -74,6 +74,10 @@ setup_options = {
     'zip_safe': False,
     'setup_requires': ['setuptools-markdown',],
     'install_requires': required_packages,
+    'extras_require': {
+        'msgpack': ['msgpack'],
+        'async': ['aiohttp>=3.3']
+    },
     'entry_points': {
         'console_scripts': [
             'unoparty-client = unopartycli:client_main',
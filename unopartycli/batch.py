@@ -0,0 +1,351 @@
+import sys
+import csv
+import json
+import time
+import queue
+import logging
+import threading
+import argparse
+import collections
+import contextlib
+import concurrent.futures
+
+from unopartylib.lib import config
+from unopartycli import util, messages, utxos, wallet
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS = 8
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_SIGN_BATCH_SIZE = 20
+DEFAULT_BROADCAST_BATCH_SIZE = 20
+UNLOCK_MARGIN = 10 # seconds
+
+class BatchError(Exception):
+    pass
+
+# Read message specs (one dict per message, with an `action` field) from a CSV or NDJSON stream.
+def read_specs(fp, input_format='auto'):
+    if input_format == 'auto':
+        first_line = fp.readline()
+        while first_line and not first_line.strip():
+            first_line = fp.readline()
+        input_format = 'ndjson' if first_line.lstrip().startswith('{') else 'csv'
+        lines = chain_first_line(first_line, fp)
+    else:
+        lines = fp
+
+    if input_format == 'ndjson':
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    elif input_format == 'csv':
+        for row in csv.DictReader(lines):
+            # Empty cells mean "use the default".
+            yield dict((key, value) for key, value in row.items() if value not in (None, ''))
+    else:
+        raise BatchError('Unknown input format: {}'.format(input_format))
+
+def chain_first_line(first_line, fp):
+    if first_line:
+        yield first_line
+    for line in fp:
+        yield line
+
+# Indexes of the messages successfully composed (or broadcast, with `key='tx_hash'`) in a previous run.
+def read_completed(fp, key='unsigned_hex'):
+    completed = set()
+    for line in fp:
+        if line.strip():
+            result = json.loads(line)
+            if key in result and 'error' not in result:
+                completed.add(result['index'])
+    return completed
+
+def message_parser_name(action):
+    if action == 'btcpay':
+        return '{}pay'.format(config.BTC).lower()
+    return action
+
+# Build the arguments of one message: the global options, then the spec parsed with the subcommand parser.
+def parse_spec(spec, message_parsers, base_args):
+    if 'action' not in spec:
+        raise BatchError('Missing `action`')
+    action = spec['action']
+    if action not in messages.MESSAGE_PARAMS or message_parser_name(action) not in message_parsers:
+        raise BatchError('Invalid message name: {}'.format(action))
+    parser = message_parsers[message_parser_name(action)]
+
+    options = {}
+    for parser_action in parser._actions:
+        for option_string in parser_action.option_strings:
+            options[option_string.lstrip('-').replace('-', '_')] = parser_action
+        options.setdefault(parser_action.dest, parser_action)
+
+    argv = []
+    for key, value in spec.items():
+        if key == 'action':
+            continue
+        if key not in options:
+            raise BatchError('Unknown argument for {}: {}'.format(action, key))
+        parser_action = options[key]
+        option_string = parser_action.option_strings[-1]
+        if parser_action.nargs == 0:
+            # Flags (`store_true`/`store_false`): only pass them to get their constant.
+            if isinstance(value, str):
+                value = value.lower() in ('1', 'true', 'yes', 'y')
+            if bool(value) == parser_action.const:
+                argv.append(option_string)
+        else:
+            argv += [option_string, str(value)]
+
+    try:
+        message_args = parser.parse_args(argv)
+    except SystemExit:
+        raise BatchError('Invalid arguments for {}: {}'.format(action, ' '.join(argv)))
+
+    args = argparse.Namespace(**vars(base_args))
+    args.__dict__.update(vars(message_args))
+    args.action = action
+    return args
+
+def missing_pubkey(pubkeyhash):
+    raise BatchError('Public key not found for {}'.format(pubkeyhash))
+
+def compose_spec(index, spec, message_parsers, base_args, utxo_allocator=None, stats=None):
+    start = time.time()
+    result = collections.OrderedDict([('index', index), ('action', spec.get('action'))])
+    try:
+        args = parse_spec(spec, message_parsers, base_args)
+        # No interactive prompt: keys not found in wallet or blockchain are an error.
+        result['unsigned_hex'] = messages.compose(args.action, args, pubkey_resolver=missing_pubkey, utxo_allocator=utxo_allocator)
+    except Exception as e:
+        logger.debug('Message {} failed: {}'.format(index, e))
+        result['error'] = str(e)
+        result['stage'] = 'compose'
+    if stats is not None:
+        stats.record(1, 1 if 'error' in result else 0, start)
+    return result
+
+def compose_batch(specs, message_parsers, base_args, jobs=DEFAULT_JOBS, skip=(), utxo_allocator=None, stats=None):
+    """
+        Compose messages concurrently, at most `jobs` at a time, and yield the
+        results in input order. Specs whose index is in `skip` are not composed.
+        With a `utxos.UTXOAllocator`, concurrent messages spend disjoint inputs.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for index, spec in enumerate(specs):
+            if index in skip:
+                continue
+            pending.append(executor.submit(compose_spec, index, spec, message_parsers, base_args, utxo_allocator, stats))
+            # Bound the read-ahead so that memory stays flat on big inputs.
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class StageStats:
+    """Throughput and latency counters of a pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.start = None
+        self.end = None
+
+    def record(self, count, errors, start):
+        now = time.time()
+        with self.lock:
+            if self.start is None:
+                self.start = start
+            self.end = now
+            self.count += count
+            self.errors += errors
+            self.busy += now - start
+
+    def as_dict(self):
+        with self.lock:
+            elapsed = (self.end - self.start) if self.start is not None else 0
+            return collections.OrderedDict([
+                ('stage', self.name),
+                ('count', self.count),
+                ('errors', self.errors),
+                ('throughput', self.count / elapsed if elapsed else None),    # per second
+                ('latency', self.busy / self.count if self.count else None)   # seconds per item
+            ])
+
+class Prefetch:
+    """
+        Run a generator in its own thread, feeding a bounded queue, so that
+        the stages of a pipeline work concurrently.
+    """
+
+    done = object()
+
+    def __init__(self, iterable, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.error = None
+        self.thread = threading.Thread(target=self.feed, args=(iterable,), daemon=True)
+        self.thread.start()
+
+    def feed(self, iterable):
+        try:
+            for item in iterable:
+                self.queue.put(item)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(self.done)
+
+    def batches(self, max_size):
+        """Yield lists of up to `max_size` items, without waiting for a batch to fill up."""
+        finished = False
+        while not finished:
+            item = self.queue.get()
+            if item is self.done:
+                break
+            batch = [item]
+            while len(batch) < max_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self.done:
+                    finished = True
+                    break
+                batch.append(item)
+            yield batch
+        if self.error is not None:
+            raise self.error
+
+class WalletUnlocker:
+    """Keep the wallet unlocked, with one `walletpassphrase` call per `timeout` seconds at most."""
+
+    def __init__(self, passphrase, timeout=wallet.DEFAULT_UNLOCK_TIMEOUT):
+        self.passphrase = passphrase
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.unlocked_until = 0
+
+    def ensure(self):
+        if self.passphrase is None:
+            return
+        with self.lock:
+            if time.time() > self.unlocked_until - UNLOCK_MARGIN:
+                logger.debug('Unlocking wallet for {} (more) seconds.'.format(self.timeout))
+                wallet.unlock(self.passphrase, timeout=self.timeout)
+                self.unlocked_until = time.time() + self.timeout
+
+def sign_batch(results, unlocker, stats):
+    start = time.time()
+    pending = [result for result in results if 'unsigned_hex' in result]
+    if pending:
+        try:
+            unlocker.ensure()
+            signed_tx_hexes = wallet.wallet_sign_raw_transactions([result['unsigned_hex'] for result in pending])
+        except Exception as e:
+            signed_tx_hexes = [e] * len(pending)
+        for result, signed_tx_hex in zip(pending, signed_tx_hexes):
+            if isinstance(signed_tx_hex, Exception):
+                result['error'] = str(signed_tx_hex)
+                result['stage'] = 'sign'
+            else:
+                result['signed_hex'] = signed_tx_hex
+    stats.record(len(pending), sum(1 for result in pending if 'error' in result), start)
+    return results
+
+def sign_batches(composed, unlocker, stats, jobs=DEFAULT_JOBS, batch_size=DEFAULT_SIGN_BATCH_SIZE):
+    """Sign batches of composed messages concurrently, and yield them in order."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for results in composed.batches(batch_size):
+            pending.append(executor.submit(sign_batch, results, unlocker, stats))
+            if len(pending) >= jobs:
+                for result in pending.popleft().result():
+                    yield result
+        while pending:
+            for result in pending.popleft().result():
+                yield result
+
+def broadcast_batches(signed, stats, batch_size=DEFAULT_BROADCAST_BATCH_SIZE, rate=0, utxo_allocator=None):
+    """Broadcast signed transactions with batched `sendrawtransaction` calls, at most `rate` per second (0: no limit)."""
+    next_time = time.time()
+    for results in signed.batches(batch_size):
+        pending = [result for result in results if 'signed_hex' in result]
+        if pending:
+            if rate:
+                time.sleep(max(0, next_time - time.time()))
+                next_time = max(next_time, time.time()) + len(pending) / rate
+            start = time.time()
+            try:
+                tx_hashes = wallet.send_raw_transactions([result['signed_hex'] for result in pending])
+            except Exception as e:
+                tx_hashes = [e] * len(pending)
+            for result, tx_hash in zip(pending, tx_hashes):
+                if isinstance(tx_hash, Exception):
+                    result['error'] = str(tx_hash)
+                    result['stage'] = 'broadcast'
+                else:
+                    result['tx_hash'] = tx_hash
+                    if utxo_allocator is not None:
+                        utxo_allocator.broadcasted(result['signed_hex'])
+            stats.record(len(pending), sum(1 for result in pending if 'error' in result), start)
+        for result in results:
+            yield result
+
+# Returns the number of failed messages by stage (`compose`, `sign` or `broadcast`).
+def run(args, message_parsers, output=None, passphrase=None):
+    output = output or sys.stdout
+
+    skip = set()
+    if args.resume:
+        with open(args.resume, 'r', encoding='utf8') as fp:
+            skip = read_completed(fp, 'tx_hash' if args.broadcast else 'unsigned_hex')
+        logger.info('Resuming: skipping {} messages already {}.'.format(len(skip), 'broadcast' if args.broadcast else 'composed'))
+
+    utxo_allocator = None
+    if args.allocate_utxos:
+        # Change outputs can only be spent again once their transaction is broadcast.
+        utxo_allocator = utxos.UTXOAllocator(ttl=args.utxo_reservation_ttl, chain_change=args.broadcast)
+
+    if args.input == '-':
+        input_fp = sys.stdin
+    else:
+        input_fp = open(args.input, 'r', encoding='utf8', newline='')
+
+    errors = collections.Counter()
+    stats = []
+    try:
+        # Keep stdout for results only; messages printed while composing go to stderr.
+        with contextlib.redirect_stdout(sys.stderr):
+            compose_stats = StageStats('compose')
+            results = compose_batch(read_specs(input_fp, args.input_format), message_parsers, args, jobs=args.jobs, skip=skip, utxo_allocator=utxo_allocator, stats=compose_stats)
+            stats.append(compose_stats)
+            if args.broadcast:
+                # compose -> sign -> broadcast, with bounded queues between the stages.
+                sign_stats, broadcast_stats = StageStats('sign'), StageStats('broadcast')
+                unlocker = WalletUnlocker(passphrase, timeout=args.unlock_timeout)
+                composed = Prefetch(results, args.queue_size)
+                signed = Prefetch(sign_batches(composed, unlocker, sign_stats, jobs=args.sign_jobs), args.queue_size)
+                results = broadcast_batches(signed, broadcast_stats, rate=args.broadcast_rate, utxo_allocator=utxo_allocator)
+                stats += [sign_stats, broadcast_stats]
+
+            for result in results:
+                if 'error' in result:
+                    errors[result['stage']] += 1
+                output.write(json.dumps(result, cls=util.JsonDecimalEncoder) + '\n')
+                output.flush()
+    finally:
+        if input_fp is not sys.stdin:
+            input_fp.close()
+
+    for stage_stats in stats:
+        logger.info('Batch stage: {}'.format(json.dumps(stage_stats.as_dict())))
+
+    return errors
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
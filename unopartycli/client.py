@@ -3,6 +3,7 @@
 import os
 import sys
 import argparse
+import collections
 import logging
 import getpass
 from decimal import Decimal as D
@@ -16,7 +17,7 @@ from unopartylib.lib.log import isodt
 from unopartylib.lib.exceptions import TransactionError
 from unopartycli.util import add_config_arguments
 from unopartycli.setup import generate_config_files
-from unopartycli import APP_VERSION, util, messages, wallet, console, clientapi
+from unopartycli import APP_VERSION, util, messages, wallet, console, clientapi, batch, utxos
 
 APP_NAME = 'unoparty-client'
 
@@ -42,7 +43,8 @@ CONFIG_ARGS = [
     [('--wallet-ssl',), {'action': 'store_true', 'default': False, 'help': 'use SSL to connect to wallet (default: false)'}],
     [('--wallet-ssl-verify',), {'action': 'store_true', 'default': False, 'help': 'verify SSL certificate of wallet; disallow use of self‐signed certificates (default: false)'}],
 
-    [('--json-output',), {'action': 'store_true', 'default': False, 'help': 'display result in json format'}],
+    [('--json-output',), {'action': 'store_true', 'default': False, 'help': 'display result in json format (same as --output json)'}],
+    [('--output',), {'choices': console.OUTPUT_FORMATS, 'default': 'pretty', 'help': 'format of the displayed result (default: pretty)'}],
     [('--unconfirmed',), {'action': 'store_true', 'default': False, 'help': 'allow the spending of unconfirmed transaction outputs'}],
     [('--encoding',), {'default': 'auto', 'type': str, 'help': 'data encoding method'}],
     [('--fee-per-kb',), {'type': D, 'default': D(config.DEFAULT_FEE_PER_KB / config.UNIT), 'help': 'fee per kilobyte, in {}'.format(config.BTC)}],
@@ -52,9 +54,259 @@ CONFIG_ARGS = [
     [('--unsigned',), {'action': 'store_true', 'default': False, 'help': 'print out unsigned hex of transaction; do not sign or broadcast'}],
     [('--disable-utxo-locks',), {'action': 'store_true', 'default': False, 'help': 'disable locking of UTXOs being spend'}],
     [('--dust-return-pubkey',), {'help': 'pubkey for dust outputs (required for P2SH)'}],
-    [('--requests-timeout',), {'type': int, 'default': clientapi.DEFAULT_REQUESTS_TIMEOUT, 'help': 'timeout value (in seconds) used for all HTTP requests (default: 5)'}]
+    [('--requests-timeout',), {'type': int, 'default': clientapi.DEFAULT_REQUESTS_TIMEOUT, 'help': 'timeout value (in seconds) used for all HTTP requests (default: 5)'}],
+    [('--rpc-pool-size',), {'type': int, 'default': util.DEFAULT_RPC_POOL_SIZE, 'help': 'number of keep-alive connections to pool for each JSON-RPC endpoint (default: {})'.format(util.DEFAULT_RPC_POOL_SIZE)}],
+    [('--api-cache-size',), {'type': float, 'default': 0, 'help': 'memory (in megabytes) used to cache read-only server responses until the next block (default: 0, disabled)'}],
+    [('--local-compose',), {'action': 'store_true', 'default': False, 'help': 'compose send, broadcast, cancel and order transactions locally, with the opreturn encoding (default: false)'}],
+    [('--local-compose-check-rate',), {'type': float, 'default': 0, 'help': 'fraction of locally composed transactions compared with the server (default: 0)'}],
+    [('--no-check-transactions',), {'action': 'store_true', 'default': False, 'help': 'do not check the outputs and fee of composed transactions before signing them'}]
 ]
 
+def add_send_parser(subparsers):
+    parser = subparsers.add_parser('send', help='create and broadcast a *send* message')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--destination', required=True, help='the destination address')
+    parser.add_argument('--quantity', required=True, help='the quantity of ASSET to send')
+    parser.add_argument('--asset', required=True, help='the ASSET of which you would like to send QUANTITY')
+    parser.add_argument('--memo', help='A transaction memo attached to this send')
+    parser.add_argument('--memo-is-hex', action='store_true', default=False, help='Whether to interpret memo as a hexadecimal value')
+    parser.add_argument('--no-use-enhanced-send', action='store_false', dest="use_enhanced_send", default=True, help='If set to false, compose a non-enhanced send with a unobtanium dust output')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_sweep_parser(subparsers):
+    parser = subparsers.add_parser('sweep', help='create and broadcast a *sweep* message')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--destination', required=True, help='the destination address')
+    parser.add_argument('--flags', default=1, help='the ORed flags for this sweep. 1 for balance sweep, 2 for ownership sweep, 4 for memo as hex. E.G. flag=7 sends all assets, transfer all ownerships and encodes the memo as hex. default=1')
+    parser.add_argument('--memo', help='A transaction memo attached to this send')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_dispenser_parser(subparsers):
+    parser = subparsers.add_parser('dispenser', help='create and broadcast a *dispenser*')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--asset', required=True, help='the ASSET of which you would like to dispense GIVE_QUANTITY')
+    parser.add_argument('--mainchainrate', required=True, help='the quantity of %s (decimal) this dispenser must receive to send the GIVEN_QUANTITY of the ASSET' % config.BTC)
+    parser.add_argument('--give-quantity', required=True, help='the quantity of ASSET that you are giving for each MAINCHAINRATE of %s received' % config.BTC)
+    parser.add_argument('--escrow-quantity', required=True, help='the quantity of ASSET that you are escrowing for this dispenser')
+    parser.add_argument('--status', default=0, help='the status for the dispenser: 0. to open the dispenser (or replenish a drained one). 10. to close the dispenser. Default 0.')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    parser.add_argument('--open-address', help='an empty address to open the dispenser on')
+    return parser
+
+def add_order_parser(subparsers):
+    parser = subparsers.add_parser('order', help='create and broadcast an *order* message')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--get-quantity', required=True, help='the quantity of GET_ASSET that you would like to receive')
+    parser.add_argument('--get-asset', required=True, help='the asset that you would like to buy')
+    parser.add_argument('--give-quantity', required=True, help='the quantity of GIVE_ASSET that you are willing to give')
+    parser.add_argument('--give-asset', required=True, help='the asset that you would like to sell')
+    parser.add_argument('--expiration', type=int, required=True, help='the number of blocks for which the order should be valid')
+    parser.add_argument('--fee-fraction-required', default=config.DEFAULT_FEE_FRACTION_REQUIRED, help='the miners’ fee required for an order to match this one, as a fraction of the {} to be bought'.format(config.BTC))
+    fees = parser.add_mutually_exclusive_group()
+    fees.add_argument('--fee-fraction-provided', default=config.DEFAULT_FEE_FRACTION_PROVIDED, help='the miners’ fee provided, as a fraction of the {} to be sold'.format(config.BTC))
+    fees.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_btcpay_parser(subparsers):
+    parser = subparsers.add_parser('{}pay'.format(config.BTC).lower(), help='create and broadcast a *{}pay* message, to settle an Order Match for which you owe {}'.format(config.BTC, config.BTC))
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--order-match-id', required=True, help='the concatenation of the hashes of the two transactions which compose the order match')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_issuance_parser(subparsers):
+    parser = subparsers.add_parser('issuance', help='issue a new asset, issue more of an existing asset or transfer the ownership of an asset')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--transfer-destination', help='for transfer of ownership of asset issuance rights')
+    parser.add_argument('--quantity', default=0, help='the quantity of ASSET to be issued')
+    parser.add_argument('--asset', required=True, help='the name of the asset to be issued (if it’s available)')
+    parser.add_argument('--divisible', action='store_true', help='whether or not the asset is divisible (must agree with previous issuances)')
+    parser.add_argument('--description', type=str, required=True, help='a description of the asset (set to ‘LOCK’ to lock against further issuances with non‐zero quantitys)')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_broadcast_parser(subparsers):
+    parser = subparsers.add_parser('broadcast', help='broadcast textual and numerical information to the network')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--text', type=str, required=True, help='the textual part of the broadcast (set to ‘LOCK’ to lock feed)')
+    parser.add_argument('--value', type=float, default=-1, help='numerical value of the broadcast')
+    parser.add_argument('--fee-fraction', default=0, help='the fraction of bets on this feed that go to its operator')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_bet_parser(subparsers):
+    parser = subparsers.add_parser('bet', help='offer to make a bet on the value of a feed')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--feed-address', required=True, help='the address which publishes the feed to bet on')
+    parser.add_argument('--bet-type', choices=list(BET_TYPE_NAME.values()), required=True, help='choices: {}'.format(list(BET_TYPE_NAME.values())))
+    parser.add_argument('--deadline', required=True, help='the date and time at which the bet should be decided/settled')
+    parser.add_argument('--wager', required=True, help='the quantity of XUP to wager')
+    parser.add_argument('--counterwager', required=True, help='the minimum quantity of XUP to be wagered by the user to bet against you, if he were to accept the whole thing')
+    parser.add_argument('--target-value', default=0.0, help='target value for Equal/NotEqual bet')
+    parser.add_argument('--leverage', type=int, default=5040, help='leverage, as a fraction of 5040')
+    parser.add_argument('--expiration', type=int, required=True, help='the number of blocks for which the bet should be valid')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_dividend_parser(subparsers):
+    parser = subparsers.add_parser('dividend', help='pay dividends to the holders of an asset (in proportion to their stake in it)')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--quantity-per-unit', required=True, help='the quantity of XUP to be paid per whole unit held of ASSET')
+    parser.add_argument('--asset', required=True, help='the asset to which pay dividends')
+    parser.add_argument('--dividend-asset', required=True, help='asset in which to pay the dividends')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_burn_parser(subparsers):
+    parser = subparsers.add_parser('burn', help='destroy {} to earn XUP, during an initial period of time')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--quantity', required=True, help='quantity of {} to be burned'.format(config.BTC))
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_cancel_parser(subparsers):
+    parser = subparsers.add_parser('cancel', help='cancel an open order or bet you created')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--offer-hash', required=True, help='the transaction hash of the order or bet')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_publish_parser(subparsers):
+    parser = subparsers.add_parser('publish', help='publish contract code in the blockchain')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--gasprice', required=True, type=int, help='the price of gas')
+    parser.add_argument('--startgas', required=True, type=int, help='the maximum quantity of {} to be used to pay for the execution (satoshis)'.format(config.XCP))
+    parser.add_argument('--endowment', required=True, type=int, help='quantity of {} to be transfered to the contract (satoshis)'.format(config.XCP))
+    parser.add_argument('--code-hex', required=True, type=str, help='the hex‐encoded contract (returned by `serpent compile`)')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_execute_parser(subparsers):
+    parser = subparsers.add_parser('execute', help='execute contract code in the blockchain')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--contract-id', required=True, help='the contract ID of the contract to be executed')
+    parser.add_argument('--gasprice', required=True, type=int, help='the price of gas')
+    parser.add_argument('--startgas', required=True, type=int, help='the maximum quantity of {} to be used to pay for the execution (satoshis)'.format(config.XCP))
+    parser.add_argument('--value', required=True, type=int, help='quantity of {} to be transfered to the contract (satoshis)'.format(config.XCP))
+    parser.add_argument('--payload-hex', required=True, type=str, help='data to be provided to the contract (returned by `serpent encode_datalist`)')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_destroy_parser(subparsers):
+    parser = subparsers.add_parser('destroy', help='destroy a quantity of a Unoparty asset')
+    parser.add_argument('--source', required=True, help='the source address')
+    parser.add_argument('--asset', required=True, help='the ASSET of which you would like to destroy QUANTITY')
+    parser.add_argument('--quantity', required=True, help='the quantity of ASSET to destroy')
+    parser.add_argument('--tag', default='', help='tag')
+    parser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
+    return parser
+
+def add_balances_parser(subparsers):
+    parser = subparsers.add_parser('balances', help='display the balances of a {} address'.format(config.XCP_NAME))
+    parser.add_argument('address', help='the address you are interested in')
+    return parser
+
+def add_asset_parser(subparsers):
+    parser = subparsers.add_parser('asset', help='display the basic properties of a {} asset'.format(config.XCP_NAME))
+    parser.add_argument('asset', help='the asset you are interested in')
+    return parser
+
+def add_wallet_parser(subparsers):
+    parser = subparsers.add_parser('wallet', help='list the addresses in your backend wallet along with their balances in all {} assets'.format(config.XCP_NAME))
+    return parser
+
+def add_pending_parser(subparsers):
+    parser = subparsers.add_parser('pending', help='list pending order matches awaiting {}payment from you'.format(config.BTC))
+    return parser
+
+def add_getrows_parser(subparsers):
+    parser = subparsers.add_parser('getrows', help='get rows from a Unoparty table')
+    parser.add_argument('--table', required=True, help='table name')
+    parser.add_argument('--filter', nargs=3, action='append', help='filters to get specific rows')
+    parser.add_argument('--filter-op', choices=['AND', 'OR'], help='operator uses to combine filters', default='AND')
+    parser.add_argument('--order-by', help='field used to order results (with --all, the column rows are paged by; default: the index of the table, if any)')
+    parser.add_argument('--order-dir', choices=['ASC', 'DESC'], help='direction used to order results')
+    parser.add_argument('--start-block', help='return only rows with block_index greater than start-block')
+    parser.add_argument('--end-block', help='return only rows with block_index lower than end-block')
+    parser.add_argument('--status', help='return only rows with the specified status')
+    parser.add_argument('--limit', help='number of rows to return (default: {}; with --all, all the rows)'.format(console.DEFAULT_GETROWS_LIMIT))
+    parser.add_argument('--offset', help='number of rows to skip', default=0)
+    parser.add_argument('--all', action='store_true', default=False, help='stream all the rows, page after page, instead of --limit rows')
+    parser.add_argument('--export', metavar='FILE', help='write all the rows to FILE, fetching block ranges in parallel')
+    parser.add_argument('--format', choices=['ndjson', 'csv'], help='output format of --all and --export (default: --output if ndjson or csv, else ndjson)')
+    parser.add_argument('--range-size', type=int, default=console.DEFAULT_EXPORT_RANGE_SIZE, help='number of blocks fetched per request, with --export (default: {})'.format(console.DEFAULT_EXPORT_RANGE_SIZE))
+    parser.add_argument('--jobs', type=int, default=console.DEFAULT_EXPORT_JOBS, help='number of block ranges fetched concurrently, with --export (default: {})'.format(console.DEFAULT_EXPORT_JOBS))
+    parser.add_argument('--retries', type=int, default=console.DEFAULT_EXPORT_RETRIES, help='number of times a failed block range is retried, with --export (default: {})'.format(console.DEFAULT_EXPORT_RETRIES))
+    return parser
+
+def add_getinfo_parser(subparsers):
+    parser = subparsers.add_parser('getinfo', help='get the current state of the server')
+    return parser
+
+def add_get_tx_info_parser(subparsers):
+    parser = subparsers.add_parser('get_tx_info', help='display info of a raw TX')
+    parser.add_argument('tx_hex', help='the raw TX')
+    return parser
+
+def add_batch_parser(subparsers):
+    parser = subparsers.add_parser('batch', help='compose many messages read from a CSV or NDJSON file and print the unsigned transactions as NDJSON')
+    parser.add_argument('--input', default='-', help='file of message specs, one per row or line, each with an `action` column naming the message type (default: stdin)')
+    parser.add_argument('--input-format', choices=['auto', 'csv', 'ndjson'], default='auto', help='format of the input file (default: auto)')
+    parser.add_argument('--jobs', type=int, default=batch.DEFAULT_JOBS, help='number of messages composed concurrently (default: {})'.format(batch.DEFAULT_JOBS))
+    parser.add_argument('--resume', help='output of a previous run; messages already composed are skipped')
+    parser.add_argument('--allocate-utxos', action='store_true', default=False, help='pick the inputs of each transaction among the wallet unspent outputs, so that concurrent messages from the same source spend different outputs')
+    parser.add_argument('--broadcast', action='store_true', default=False, help='sign the composed transactions with the wallet and broadcast them')
+    parser.add_argument('--sign-jobs', type=int, default=4, help='number of signing requests run concurrently, with --broadcast (default: 4)')
+    parser.add_argument('--broadcast-rate', type=float, default=0, help='maximum number of transactions broadcast per second, with --broadcast (default: 0, no limit)')
+    parser.add_argument('--queue-size', type=int, default=batch.DEFAULT_QUEUE_SIZE, help='maximum number of transactions waiting between two stages, with --broadcast (default: {})'.format(batch.DEFAULT_QUEUE_SIZE))
+    parser.add_argument('--unlock-timeout', type=int, default=wallet.DEFAULT_UNLOCK_TIMEOUT, help='seconds the wallet is unlocked for at a time, with --broadcast (default: {})'.format(wallet.DEFAULT_UNLOCK_TIMEOUT))
+    parser.add_argument('--utxo-reservation-ttl', type=int, default=utxos.DEFAULT_RESERVATION_TTL, help='seconds an allocated output stays reserved (default: {})'.format(utxos.DEFAULT_RESERVATION_TTL))
+    return parser
+
+def get_action_parsers():
+    return collections.OrderedDict([
+        ('send', add_send_parser),
+        ('sweep', add_sweep_parser),
+        ('dispenser', add_dispenser_parser),
+        ('order', add_order_parser),
+        ('{}pay'.format(config.BTC).lower(), add_btcpay_parser),
+        ('issuance', add_issuance_parser),
+        ('broadcast', add_broadcast_parser),
+        ('bet', add_bet_parser),
+        ('dividend', add_dividend_parser),
+        ('burn', add_burn_parser),
+        ('cancel', add_cancel_parser),
+        ('publish', add_publish_parser),
+        ('execute', add_execute_parser),
+        ('destroy', add_destroy_parser),
+        ('balances', add_balances_parser),
+        ('asset', add_asset_parser),
+        ('wallet', add_wallet_parser),
+        ('pending', add_pending_parser),
+        ('getrows', add_getrows_parser),
+        ('getinfo', add_getinfo_parser),
+        ('get_tx_info', add_get_tx_info_parser),
+        ('batch', add_batch_parser)
+    ])
+
+# The action named on the command line: the first argument that is neither a global option nor
+# its value. `None` if the help is requested or anything else comes first (like an abbreviated option).
+def get_action(parser, argv):
+    expects_value = False
+    for arg in argv:
+        if expects_value:
+            expects_value = False
+            continue
+        if not arg.startswith('-'):
+            return arg
+        option = parser._option_string_actions.get(arg.split('=', 1)[0])
+        if option is None or option.dest == 'help':
+            return None
+        expects_value = option.nargs != 0 and '=' not in arg
+    return None
+
 def main():
     if os.name == 'nt':
         from unopartylib.lib import util_windows
@@ -72,150 +324,26 @@ def main():
 
     add_config_arguments(parser, CONFIG_ARGS, 'client.conf')
 
-    subparsers = parser.add_subparsers(dest='action', help='the action to be taken')
+    # Only the parser of the chosen action is built: all of them are needed for the help, an
+    # unknown action or a batch (whose specs may use any message).
+    action_parsers = get_action_parsers()
+    action = get_action(parser, sys.argv[1:])
+    if action in action_parsers and action != 'batch':
+        actions = [action]
+    else:
+        actions = list(action_parsers.keys())
 
-    parser_send = subparsers.add_parser('send', help='create and broadcast a *send* message')
-    parser_send.add_argument('--source', required=True, help='the source address')
-    parser_send.add_argument('--destination', required=True, help='the destination address')
-    parser_send.add_argument('--quantity', required=True, help='the quantity of ASSET to send')
-    parser_send.add_argument('--asset', required=True, help='the ASSET of which you would like to send QUANTITY')
-    parser_send.add_argument('--memo', help='A transaction memo attached to this send')
-    parser_send.add_argument('--memo-is-hex', action='store_true', default=False, help='Whether to interpret memo as a hexadecimal value')
-    parser_send.add_argument('--no-use-enhanced-send', action='store_false', dest="use_enhanced_send", default=True, help='If set to false, compose a non-enhanced send with a unobtanium dust output')
-    parser_send.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_sweep = subparsers.add_parser('sweep', help='create and broadcast a *sweep* message')
-    parser_sweep.add_argument('--source', required=True, help='the source address')
-    parser_sweep.add_argument('--destination', required=True, help='the destination address')
-    parser_sweep.add_argument('--flags', default=1, help='the ORed flags for this sweep. 1 for balance sweep, 2 for ownership sweep, 4 for memo as hex. E.G. flag=7 sends all assets, transfer all ownerships and encodes the memo as hex. default=1')
-    parser_sweep.add_argument('--memo', help='A transaction memo attached to this send')
-    parser_sweep.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_dispenser = subparsers.add_parser('dispenser', help='create and broadcast a *dispenser*')
-    parser_dispenser.add_argument('--source', required=True, help='the source address')
-    parser_dispenser.add_argument('--asset', required=True, help='the ASSET of which you would like to dispense GIVE_QUANTITY')
-    parser_dispenser.add_argument('--mainchainrate', required=True, help='the quantity of %s (decimal) this dispenser must receive to send the GIVEN_QUANTITY of the ASSET' % config.BTC)
-    parser_dispenser.add_argument('--give-quantity', required=True, help='the quantity of ASSET that you are giving for each MAINCHAINRATE of %s received' % config.BTC)
-    parser_dispenser.add_argument('--escrow-quantity', required=True, help='the quantity of ASSET that you are escrowing for this dispenser')
-    parser_dispenser.add_argument('--status', default=0, help='the status for the dispenser: 0. to open the dispenser (or replenish a drained one). 10. to close the dispenser. Default 0.')
-    parser_dispenser.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-    parser_dispenser.add_argument('--open-address', help='an empty address to open the dispenser on')
-
-    parser_order = subparsers.add_parser('order', help='create and broadcast an *order* message')
-    parser_order.add_argument('--source', required=True, help='the source address')
-    parser_order.add_argument('--get-quantity', required=True, help='the quantity of GET_ASSET that you would like to receive')
-    parser_order.add_argument('--get-asset', required=True, help='the asset that you would like to buy')
-    parser_order.add_argument('--give-quantity', required=True, help='the quantity of GIVE_ASSET that you are willing to give')
-    parser_order.add_argument('--give-asset', required=True, help='the asset that you would like to sell')
-    parser_order.add_argument('--expiration', type=int, required=True, help='the number of blocks for which the order should be valid')
-    parser_order.add_argument('--fee-fraction-required', default=config.DEFAULT_FEE_FRACTION_REQUIRED, help='the miners’ fee required for an order to match this one, as a fraction of the {} to be bought'.format(config.BTC))
-    parser_order_fees = parser_order.add_mutually_exclusive_group()
-    parser_order_fees.add_argument('--fee-fraction-provided', default=config.DEFAULT_FEE_FRACTION_PROVIDED, help='the miners’ fee provided, as a fraction of the {} to be sold'.format(config.BTC))
-    parser_order_fees.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_btcpay = subparsers.add_parser('{}pay'.format(config.BTC).lower(), help='create and broadcast a *{}pay* message, to settle an Order Match for which you owe {}'.format(config.BTC, config.BTC))
-    parser_btcpay.add_argument('--source', required=True, help='the source address')
-    parser_btcpay.add_argument('--order-match-id', required=True, help='the concatenation of the hashes of the two transactions which compose the order match')
-    parser_btcpay.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_issuance = subparsers.add_parser('issuance', help='issue a new asset, issue more of an existing asset or transfer the ownership of an asset')
-    parser_issuance.add_argument('--source', required=True, help='the source address')
-    parser_issuance.add_argument('--transfer-destination', help='for transfer of ownership of asset issuance rights')
-    parser_issuance.add_argument('--quantity', default=0, help='the quantity of ASSET to be issued')
-    parser_issuance.add_argument('--asset', required=True, help='the name of the asset to be issued (if it’s available)')
-    parser_issuance.add_argument('--divisible', action='store_true', help='whether or not the asset is divisible (must agree with previous issuances)')
-    parser_issuance.add_argument('--description', type=str, required=True, help='a description of the asset (set to ‘LOCK’ to lock against further issuances with non‐zero quantitys)')
-    parser_issuance.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_broadcast = subparsers.add_parser('broadcast', help='broadcast textual and numerical information to the network')
-    parser_broadcast.add_argument('--source', required=True, help='the source address')
-    parser_broadcast.add_argument('--text', type=str, required=True, help='the textual part of the broadcast (set to ‘LOCK’ to lock feed)')
-    parser_broadcast.add_argument('--value', type=float, default=-1, help='numerical value of the broadcast')
-    parser_broadcast.add_argument('--fee-fraction', default=0, help='the fraction of bets on this feed that go to its operator')
-    parser_broadcast.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_bet = subparsers.add_parser('bet', help='offer to make a bet on the value of a feed')
-    parser_bet.add_argument('--source', required=True, help='the source address')
-    parser_bet.add_argument('--feed-address', required=True, help='the address which publishes the feed to bet on')
-    parser_bet.add_argument('--bet-type', choices=list(BET_TYPE_NAME.values()), required=True, help='choices: {}'.format(list(BET_TYPE_NAME.values())))
-    parser_bet.add_argument('--deadline', required=True, help='the date and time at which the bet should be decided/settled')
-    parser_bet.add_argument('--wager', required=True, help='the quantity of XUP to wager')
-    parser_bet.add_argument('--counterwager', required=True, help='the minimum quantity of XUP to be wagered by the user to bet against you, if he were to accept the whole thing')
-    parser_bet.add_argument('--target-value', default=0.0, help='target value for Equal/NotEqual bet')
-    parser_bet.add_argument('--leverage', type=int, default=5040, help='leverage, as a fraction of 5040')
-    parser_bet.add_argument('--expiration', type=int, required=True, help='the number of blocks for which the bet should be valid')
-    parser_bet.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_dividend = subparsers.add_parser('dividend', help='pay dividends to the holders of an asset (in proportion to their stake in it)')
-    parser_dividend.add_argument('--source', required=True, help='the source address')
-    parser_dividend.add_argument('--quantity-per-unit', required=True, help='the quantity of XUP to be paid per whole unit held of ASSET')
-    parser_dividend.add_argument('--asset', required=True, help='the asset to which pay dividends')
-    parser_dividend.add_argument('--dividend-asset', required=True, help='asset in which to pay the dividends')
-    parser_dividend.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_burn = subparsers.add_parser('burn', help='destroy {} to earn XUP, during an initial period of time')
-    parser_burn.add_argument('--source', required=True, help='the source address')
-    parser_burn.add_argument('--quantity', required=True, help='quantity of {} to be burned'.format(config.BTC))
-    parser_burn.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_cancel = subparsers.add_parser('cancel', help='cancel an open order or bet you created')
-    parser_cancel.add_argument('--source', required=True, help='the source address')
-    parser_cancel.add_argument('--offer-hash', required=True, help='the transaction hash of the order or bet')
-    parser_cancel.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_publish = subparsers.add_parser('publish', help='publish contract code in the blockchain')
-    parser_publish.add_argument('--source', required=True, help='the source address')
-    parser_publish.add_argument('--gasprice', required=True, type=int, help='the price of gas')
-    parser_publish.add_argument('--startgas', required=True, type=int, help='the maximum quantity of {} to be used to pay for the execution (satoshis)'.format(config.XCP))
-    parser_publish.add_argument('--endowment', required=True, type=int, help='quantity of {} to be transfered to the contract (satoshis)'.format(config.XCP))
-    parser_publish.add_argument('--code-hex', required=True, type=str, help='the hex‐encoded contract (returned by `serpent compile`)')
-    parser_publish.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_execute = subparsers.add_parser('execute', help='execute contract code in the blockchain')
-    parser_execute.add_argument('--source', required=True, help='the source address')
-    parser_execute.add_argument('--contract-id', required=True, help='the contract ID of the contract to be executed')
-    parser_execute.add_argument('--gasprice', required=True, type=int, help='the price of gas')
-    parser_execute.add_argument('--startgas', required=True, type=int, help='the maximum quantity of {} to be used to pay for the execution (satoshis)'.format(config.XCP))
-    parser_execute.add_argument('--value', required=True, type=int, help='quantity of {} to be transfered to the contract (satoshis)'.format(config.XCP))
-    parser_execute.add_argument('--payload-hex', required=True, type=str, help='data to be provided to the contract (returned by `serpent encode_datalist`)')
-    parser_execute.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_destroy = subparsers.add_parser('destroy', help='destroy a quantity of a Unoparty asset')
-    parser_destroy.add_argument('--source', required=True, help='the source address')
-    parser_destroy.add_argument('--asset', required=True, help='the ASSET of which you would like to destroy QUANTITY')
-    parser_destroy.add_argument('--quantity', required=True, help='the quantity of ASSET to destroy')
-    parser_destroy.add_argument('--tag', default='', help='tag')
-    parser_destroy.add_argument('--fee', help='the exact {} fee to be paid to miners'.format(config.BTC))
-
-    parser_address = subparsers.add_parser('balances', help='display the balances of a {} address'.format(config.XCP_NAME))
-    parser_address.add_argument('address', help='the address you are interested in')
-
-    parser_asset = subparsers.add_parser('asset', help='display the basic properties of a {} asset'.format(config.XCP_NAME))
-    parser_asset.add_argument('asset', help='the asset you are interested in')
-
-    parser_wallet = subparsers.add_parser('wallet', help='list the addresses in your backend wallet along with their balances in all {} assets'.format(config.XCP_NAME))
-
-    parser_pending = subparsers.add_parser('pending', help='list pending order matches awaiting {}payment from you'.format(config.BTC))
-
-    parser_getrows = subparsers.add_parser('getrows', help='get rows from a Unoparty table')
-    parser_getrows.add_argument('--table', required=True, help='table name')
-    parser_getrows.add_argument('--filter', nargs=3, action='append', help='filters to get specific rows')
-    parser_getrows.add_argument('--filter-op', choices=['AND', 'OR'], help='operator uses to combine filters', default='AND')
-    parser_getrows.add_argument('--order-by', help='field used to order results')
-    parser_getrows.add_argument('--order-dir', choices=['ASC', 'DESC'], help='direction used to order results')
-    parser_getrows.add_argument('--start-block', help='return only rows with block_index greater than start-block')
-    parser_getrows.add_argument('--end-block', help='return only rows with block_index lower than end-block')
-    parser_getrows.add_argument('--status', help='return only rows with the specified status')
-    parser_getrows.add_argument('--limit', help='number of rows to return', default=100)
-    parser_getrows.add_argument('--offset', help='number of rows to skip', default=0)
-
-    parser_getrunninginfo = subparsers.add_parser('getinfo', help='get the current state of the server')
-
-    parser_get_tx_info = subparsers.add_parser('get_tx_info', help='display info of a raw TX')
-    parser_get_tx_info.add_argument('tx_hex', help='the raw TX')
+    subparsers = parser.add_subparsers(dest='action', help='the action to be taken')
+    for name in actions:
+        action_parsers[name](subparsers)
 
     args = parser.parse_args()
 
+    if args.json_output:
+        args.output = 'json'
+    if args.action == 'getrows' and args.format is None:
+        args.format = args.output if args.output in ('ndjson', 'csv') else 'ndjson'
+
     # Logging
     log.set_up(logger, verbose=args.verbose)
     logger.propagate = False
@@ -235,7 +363,10 @@ def main():
                         wallet_name=args.wallet_name, wallet_connect=args.wallet_connect, wallet_port=args.wallet_port,
                         wallet_user=args.wallet_user, wallet_password=args.wallet_password,
                         wallet_ssl=args.wallet_ssl, wallet_ssl_verify=args.wallet_ssl_verify,
-                        requests_timeout=args.requests_timeout)
+                        requests_timeout=args.requests_timeout, rpc_pool_size=args.rpc_pool_size,
+                        api_cache_size=args.api_cache_size, local_compose=args.local_compose,
+                        local_compose_check_rate=args.local_compose_check_rate,
+                        check_transactions=not args.no_check_transactions)
 
     # MESSAGE CREATION
     if args.action in list(messages.MESSAGE_PARAMS.keys()):
@@ -264,14 +395,37 @@ def main():
                 logger.info('Hash of transaction (broadcasted): {}'.format(tx_hash))
 
 
+    # BATCH
+    elif args.action == 'batch':
+        message_parsers = dict((name, subparser) for name, subparser in subparsers.choices.items() if name not in ['batch'])
+        passphrase = None
+        if args.broadcast and wallet.is_locked():
+            # Asked once; the wallet is unlocked again as needed during the batch.
+            passphrase = getpass.getpass('Enter your wallet passhrase: ')
+        errors = batch.run(args, message_parsers, passphrase=passphrase)
+        if errors:
+            logger.warning('{} messages failed ({}).'.format(sum(errors.values()), ', '.join('{} at the {} stage'.format(count, stage) for stage, count in errors.items())))
+            sys.exit(1)
+
+    # STREAMING
+    elif args.action == 'getrows' and args.export:
+        with open(args.export, 'w', encoding='utf8', newline='') as fp:
+            rows = console.export_getrows(args, fp, progress=sys.stderr)
+        logger.info('{} rows written to {}.'.format(rows, args.export))
+
+    elif args.action == 'getrows' and args.all:
+        console.write_rows(console.stream_getrows(args), args.format, sys.stdout)
+
     # VIEWING
     elif args.action in ['balances', 'asset', 'wallet', 'pending', 'getinfo', 'getrows', 'get_tx_info']:
         view = console.get_view(args.action, args)
         print_method = getattr(console, 'print_{}'.format(args.action), None)
-        if args.json_output or print_method is None:
-            util.json_print(view)
-        else:
+        if args.output == 'pretty' and print_method is None:
+            args.output = 'json'
+        if args.output == 'pretty':
             print_method(view)
+        else:
+            console.write_output(view, args.output)
 
     else:
         parser.print_help()
@@ -1,6 +1,10 @@
 import sys
+import json
+import time
 import logging
+import weakref
 import binascii
+import functools
 from urllib.parse import quote_plus as urlencode
 
 from unopartylib.lib import config, script
@@ -12,6 +16,7 @@ from unopartycli.messages import get_pubkeys
 logger = logging.getLogger()
 
 DEFAULT_REQUESTS_TIMEOUT = 5 # seconds
+DEFAULT_ASYNC_CONCURRENCY = 64
 
 class ConfigurationError(Exception):
     pass
@@ -23,7 +28,10 @@ def initialize(testnet=False, testcoin=False, regtest=True, customnet="",
                 wallet_name=None, wallet_connect=None, wallet_port=None,
                 wallet_user=None, wallet_password=None,
                 wallet_ssl=False, wallet_ssl_verify=False,
-                requests_timeout=DEFAULT_REQUESTS_TIMEOUT):
+                requests_timeout=DEFAULT_REQUESTS_TIMEOUT,
+                rpc_pool_size=util.DEFAULT_RPC_POOL_SIZE,
+                api_cache_size=0, local_compose=False, local_compose_check_rate=0,
+                check_transactions=True):
 
     def handle_exception(exc_type, exc_value, exc_traceback):
         logger.error("Unhandled Exception", exc_info=(exc_type, exc_value, exc_traceback))
@@ -142,6 +150,22 @@ def initialize(testnet=False, testcoin=False, regtest=True, customnet="",
 
     config.REQUESTS_TIMEOUT = requests_timeout
 
+    # Connection pool size, per JSON-RPC endpoint
+    config.RPC_POOL_SIZE = rpc_pool_size
+    util.close_rpc_sessions()
+
+    # Cache of read-only server responses, in megabytes (0 to disable)
+    config.API_CACHE_SIZE = api_cache_size
+    util.enable_api_cache(int(api_cache_size * 1024 * 1024))
+
+    # Compose `send`, `broadcast`, `cancel` and `order` messages in-process, checking
+    # a fraction of them against the server
+    config.LOCAL_COMPOSE = local_compose or False
+    config.LOCAL_COMPOSE_CHECK_RATE = local_compose_check_rate or 0
+
+    # Check the outputs and fee of the transactions composed by the CLI before signing
+    config.CHECK_TRANSACTIONS = check_transactions
+
     # Encoding
     if config.TESTCOIN:
         config.PREFIX = b'XX'                   # 2 bytes (possibly accidentally created)
@@ -211,13 +235,46 @@ def initialize(testnet=False, testcoin=False, regtest=True, customnet="",
             config.BURN_END = config.BURN_END_MAINNET
             config.UNSPENDABLE = config.UNSPENDABLE_MAINNET
 
+def close():
+    """
+        Close the pooled connections to the server and the wallet.
+        Applications embedding the client should call it on shutdown.
+    """
+    global async_client
+    if async_client is not None:
+        async_client.close()
+        async_client = None
+    util.close_rpc_sessions()
+
+def connection_stats():
+    """
+        Number of requests, opened connections and keep-alive reuses by endpoint.
+    """
+    return util.rpc_session_stats()
+
+def cache_stats():
+    """
+        Hit/miss counters of the server response cache (`None` if disabled).
+    """
+    return util.api_cache_stats()
+
 WALLET_METHODS = [
-    'get_wallet_addresses', 'get_btc_balances', 'sign_raw_transaction',
+    'get_wallet_addresses', 'get_btc_balances', 'sign_raw_transaction', 'sign_raw_transactions',
     'get_pubkey', 'is_valid', 'is_mine', 'get_btc_balance', 'send_raw_transaction',
     'wallet', 'asset', 'balances', 'pending', 'is_locked', 'unlock', 'wallet_last_block',
-    'sweep'
+    'sweep', 'send_raw_transactions', 'wallet_sign_raw_transactions'
 ]
 
+# Get provided pubkeys from params.
+def add_pubkeys(args, pubkey_resolver=None):
+    pubkeys = []
+    for address_name in ['source', 'destination']:
+        if address_name in args:
+            address = args[address_name]
+            if script.is_multisig(address) or address_name != 'destination':    # We don’t need the pubkey for a mono‐sig destination.
+                pubkeys += get_pubkeys(address, pubkey_resolver=pubkey_resolver)
+    args['pubkey'] = pubkeys
+
 def call(method, args, pubkey_resolver=None):
     """
         Unified function to call Wallet and Server API methods
@@ -236,14 +293,7 @@ def call(method, args, pubkey_resolver=None):
         return func(**args)
     else:
         if method.startswith('create_'):
-            # Get provided pubkeys from params.
-            pubkeys = []
-            for address_name in ['source', 'destination']:
-                if address_name in args:
-                    address = args[address_name]
-                    if script.is_multisig(address) or address_name != 'destination':    # We don’t need the pubkey for a mono‐sig destination.
-                        pubkeys += get_pubkeys(address, pubkey_resolver=pubkey_resolver)
-            args['pubkey'] = pubkeys
+            add_pubkeys(args, pubkey_resolver=pubkey_resolver)
 
         result = util.api(method, args)
 
@@ -252,5 +302,177 @@ def call(method, args, pubkey_resolver=None):
 
         return result
 
+class AsyncClient:
+    """
+        asyncio counterpart of `call`, `util.api` and `util.wallet_api`
+
+        Calls keep the exact semantics of their blocking versions (including
+        pubkey resolution and `messages.check_transaction` for `create_*`
+        methods). At most `concurrency` calls are in flight at the same time
+        in each event loop, each one bounded by `timeout` seconds (`None` for
+        no limit).
+
+        JSON-RPC requests are sent with `aiohttp` (`pip install unoparty-cli[async]`).
+        Without it, and for the wallet-side work of `call` (signing, pubkey
+        lookups), the blocking functions run in a thread pool.
+
+        `asyncio` is only imported by the asynchronous API, so that the
+        blocking clients don't pay for it.
+
+        :Example:
+
+        client = clientapi.AsyncClient(concurrency=100, timeout=30)
+        balances = await asyncio.gather(*[
+            client.api('get_balances', {'filters': [('address', '==', address)]}) for address in addresses
+        ])
+        await client.aclose()
+    """
+    def __init__(self, concurrency=DEFAULT_ASYNC_CONCURRENCY, timeout=None):
+        import concurrent.futures
+        self.concurrency = concurrency
+        self.timeout = timeout
+        try:
+            import aiohttp
+            self.aiohttp = aiohttp
+        except ImportError:
+            logger.debug('aiohttp not found; running the asyncio API calls in threads.')
+            self.aiohttp = None
+        # asyncio objects belong to one event loop: one semaphore and one HTTP session per loop.
+        self.semaphores = weakref.WeakKeyDictionary()
+        self.sessions = weakref.WeakKeyDictionary()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    def get_semaphore(self):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        if loop not in self.semaphores:
+            self.semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return self.semaphores[loop]
+
+    def get_session(self):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        if loop not in self.sessions or self.sessions[loop].closed:
+            pool_size = getattr(config, 'RPC_POOL_SIZE', util.DEFAULT_RPC_POOL_SIZE)
+            connector = self.aiohttp.TCPConnector(limit_per_host=pool_size)
+            timeout = self.aiohttp.ClientTimeout(total=config.REQUESTS_TIMEOUT)
+            self.sessions[loop] = self.aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.sessions[loop]
+
+    async def limit(self, coroutine, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        import asyncio
+        async with self.get_semaphore():
+            return await asyncio.wait_for(coroutine, timeout)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def rpc(self, url, method, params=None, ssl_verify=False):
+        if self.aiohttp is None:
+            return await self.run_blocking(util.rpc, url, method, params=params, ssl_verify=ssl_verify)
+        payload = {
+            "method": method,
+            "params": params,
+            "jsonrpc": "2.0",
+            "id": 0,
+        }
+        headers = {'content-type': 'application/json'}
+        try:
+            # Credentials in the URL are sent as basic authentication.
+            async with self.get_session().post(url, data=json.dumps(payload), headers=headers, ssl=None if ssl_verify else False) as response:
+                if response.status not in (200, 500):
+                    raise util.RPCError('{} {} {}'.format(response.status, response.reason, await response.text()))
+                response_json = await response.json(content_type=None)
+        except self.aiohttp.ClientConnectionError:
+            raise util.RPCError('Cannot communicate with {}.'.format(url))
+        return util.rpc_result(response_json)
+
+    async def server_api(self, method, params=None):
+        # Same as `util.api`, including the server response cache.
+        api_cache = util.api_cache
+        if api_cache is None or method not in util.API_CACHE_METHODS:
+            result = await self.rpc(config.UNOPARTY_RPC, method, params, ssl_verify=config.UNOPARTY_RPC_SSL_VERIFY)
+            if api_cache is not None and method == 'get_running_info':
+                api_cache.update_block(result)
+            return result
+
+        if time.time() - api_cache.last_block_check >= util.API_CACHE_BLOCK_CHECK_INTERVAL:
+            api_cache.update_block(await self.rpc(config.UNOPARTY_RPC, 'get_running_info', ssl_verify=config.UNOPARTY_RPC_SSL_VERIFY))
+        key = api_cache.key(method, params)
+        found, result = api_cache.get(key)
+        if found:
+            return result
+        generation = api_cache.generation
+        result = await self.rpc(config.UNOPARTY_RPC, method, params, ssl_verify=config.UNOPARTY_RPC_SSL_VERIFY)
+        api_cache.put(key, result, generation)
+        return result
+
+    async def create(self, method, args, pubkey_resolver=None):
+        # `call` for the `create_*` methods: the server request itself is asynchronous.
+        await self.run_blocking(add_pubkeys, args, pubkey_resolver=pubkey_resolver)
+        result = await self.server_api(method, args)
+        await self.run_blocking(messages.check_transaction, method, args, result)
+        return result
+
+    async def call(self, method, args, pubkey_resolver=None, timeout=None):
+        if method in WALLET_METHODS:
+            coroutine = self.run_blocking(call, method, args)
+        elif method.startswith('create_'):
+            coroutine = self.create(method, args, pubkey_resolver=pubkey_resolver)
+        else:
+            coroutine = self.server_api(method, args)
+        return await self.limit(coroutine, timeout=timeout)
+
+    async def api(self, method, params=None, timeout=None):
+        return await self.limit(self.server_api(method, params), timeout=timeout)
+
+    async def wallet_api(self, method, params=None, timeout=None):
+        return await self.limit(self.rpc(config.WALLET_URL, method, params, ssl_verify=config.WALLET_SSL_VERIFY), timeout=timeout)
+
+    async def aclose(self):
+        """Close the HTTP session of the running event loop."""
+        import asyncio
+        session = self.sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def close(self):
+        import asyncio
+        self.executor.shutdown(wait=False)
+        for loop, session in list(self.sessions.items()):
+            if loop.is_closed() or session.closed:
+                continue
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(session.close(), loop)
+            else:
+                loop.run_until_complete(session.close())
+        self.sessions.clear()
+
+async_client = None
+
+async def acall(method, args, pubkey_resolver=None, timeout=None):
+    """
+        asyncio version of `call`, sharing a default `AsyncClient`
+
+        :Example:
+
+        unsigned_hex = await clientapi.acall('create_send', {...})
+    """
+    global async_client
+    if async_client is None:
+        async_client = AsyncClient()
+    return await async_client.call(method, args, pubkey_resolver=pubkey_resolver, timeout=timeout)
+
+async def aclose():
+    """
+        Close the connections of the default `AsyncClient` opened in the running
+        event loop. Should be awaited before the loop ends.
+    """
+    if async_client is not None:
+        await async_client.aclose()
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
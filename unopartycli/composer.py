@@ -0,0 +1,326 @@
+import time
+import struct
+import random
+import logging
+import binascii
+import threading
+from math import ceil
+
+from unopartylib.lib import config, arc4, message_type
+from unopartylib.lib.util import enabled, generate_asset_id
+from unopartylib.lib.messages import broadcast, cancel, order
+from unopartylib.lib.messages.versions import enhanced_send
+from unopartycli import util, wallet, utxos, signing
+
+logger = logging.getLogger(__name__)
+
+# Compose the most frequent messages in-process instead of calling `create_*` on the server.
+#
+# Transactions are built like the server does with the `opreturn` encoding: inputs from the wallet
+# UTXO snapshot (or a `utxos.UTXOAllocator`), the ARC4-obfuscated message in an OP_RETURN output and
+# a change output. Messages are checked like the server does before composing them (asset existence,
+# quantity and expiration limits, balances, feed and offer state), with one API request per message.
+# Anything unsupported or invalid raises `LocalComposeError`, and the caller falls back to the server,
+# which reports the actual error.
+
+LOCAL_MESSAGES = ['send', 'broadcast', 'cancel', 'order']
+MAX_INT = 2**63 - 1
+MAX_FEE_FRACTION_INT = 4294967295
+MAX_MEMO_LENGTH = 34
+MAX_INPUT_SELECTION_TRIES = 8
+
+class LocalComposeError(Exception):
+    pass
+
+running_info = {'block_index': None, 'time': 0}
+running_info_lock = threading.Lock()
+
+# Index of the last block parsed by the server, which decides the enabled protocol changes. It is
+# checked as often as the API cache checks for new blocks.
+def get_block_index():
+    with running_info_lock:
+        if running_info['block_index'] is None or time.time() - running_info['time'] >= util.API_CACHE_BLOCK_CHECK_INTERVAL:
+            last_block = util.api('get_running_info').get('last_block')
+            if not last_block:
+                raise LocalComposeError('the server has not parsed any block yet')
+            running_info['block_index'] = last_block['block_index']
+            running_info['time'] = time.time()
+        return running_info['block_index']
+
+def get_asset_id(asset, block_index):
+    if '.' in asset:
+        raise LocalComposeError('subassets are composed by the server')
+    try:
+        return generate_asset_id(asset, block_index)
+    except Exception as e:
+        raise LocalComposeError('invalid asset name {}: {}'.format(asset, e))
+
+# Enhanced sends pack the destination in 21 bytes: only base58 addresses (version byte and hash) fit.
+# The network of a bech32 address can't be checked offline, and a P2WSH program doesn't fit.
+def pack_address(address):
+    if not util.validate_address(address):
+        raise LocalComposeError('destination {} is packed by the server'.format(address))
+    return util.base58_check_decode(address)
+
+def pack_send(params, block_index):
+    if params.get('asset') == config.BTC:
+        raise LocalComposeError('{} sends are composed by the server'.format(config.BTC))
+    if not params.get('use_enhanced_send', True) or not enabled('enhanced_sends', block_index):
+        raise LocalComposeError('only enhanced sends are composed locally')
+
+    memo = params.get('memo')
+    if memo is None:
+        memo_bytes = b''
+    elif params.get('memo_is_hex'):
+        memo_bytes = bytes.fromhex(memo)
+    else:
+        memo_bytes = memo.encode('utf-8')
+    if len(memo_bytes) > MAX_MEMO_LENGTH:
+        raise LocalComposeError('memo too long')
+
+    destination = pack_address(params['destination'])
+    data = message_type.pack(enhanced_send.ID, block_index)
+    data += struct.pack(enhanced_send.FORMAT, get_asset_id(params['asset'], block_index), params['quantity'], destination)
+    return data + memo_bytes
+
+def pack_broadcast(params, block_index):
+    text = params['text']
+    if len(text) <= 52:
+        curr_format = broadcast.FORMAT + '{}p'.format(len(text) + 1)
+    else:
+        curr_format = broadcast.FORMAT + '{}s'.format(len(text))
+    fee_fraction_int = int(params['fee_fraction'] * 1e8)
+    data = message_type.pack(broadcast.ID, block_index)
+    return data + struct.pack(curr_format, params['timestamp'], params['value'], fee_fraction_int, text.encode('utf-8'))
+
+def pack_cancel(params, block_index):
+    try:
+        offer_hash = binascii.unhexlify(params['offer_hash'])
+    except (binascii.Error, TypeError):
+        raise LocalComposeError('invalid offer hash')
+    if len(offer_hash) != 32:
+        raise LocalComposeError('invalid offer hash')
+    return message_type.pack(cancel.ID, block_index) + struct.pack(cancel.FORMAT, offer_hash)
+
+def pack_order(params, block_index):
+    if params['give_asset'] == config.BTC:
+        # The server adds the provided fee to the transaction fee.
+        raise LocalComposeError('orders giving {} are composed by the server'.format(config.BTC))
+    if params['give_asset'] == params['get_asset']:
+        raise LocalComposeError('trading an asset for itself')
+    data = message_type.pack(order.ID, block_index)
+    return data + struct.pack(order.FORMAT,
+                              get_asset_id(params['give_asset'], block_index), params['give_quantity'],
+                              get_asset_id(params['get_asset'], block_index), params['get_quantity'],
+                              params['expiration'], params['fee_required'])
+
+def check_quantity(params, name):
+    quantity = params.get(name)
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or not 0 < quantity <= MAX_INT:
+        raise LocalComposeError('invalid {}'.format(name))
+
+def check_assets(assets):
+    try:
+        util.get_divisibilities(assets)
+    except util.AssetError as e:
+        raise LocalComposeError(str(e))
+
+def get_balance_call(address, asset):
+    return ('get_balances', {'filters': [('address', '==', address), ('asset', '==', asset)]})
+
+def check_balance(balances, address, asset, quantity):
+    if sum(balance['quantity'] for balance in balances) < quantity:
+        raise LocalComposeError('insufficient {} at address {}'.format(asset, address))
+
+def validate_send(params):
+    check_quantity(params, 'quantity')
+    check_assets([params['asset']])
+    balances, = util.api_batch([get_balance_call(params['source'], params['asset'])])
+    check_balance(balances, params['source'], params['asset'], params['quantity'])
+
+def validate_broadcast(params):
+    if not isinstance(params['timestamp'], int) or params['timestamp'] < 0:
+        raise LocalComposeError('invalid timestamp')
+    if not 0 <= int(params['fee_fraction'] * 1e8) <= MAX_FEE_FRACTION_INT:
+        raise LocalComposeError('invalid fee fraction')
+    last_broadcasts, = util.api_batch([('get_broadcasts', {
+        'filters': [('source', '==', params['source'])],
+        'status': 'valid',
+        'order_by': 'tx_index',
+        'order_dir': 'DESC',
+        'limit': 1
+    })])
+    if last_broadcasts:
+        if last_broadcasts[0]['locked']:
+            raise LocalComposeError('locked feed')
+        if params['timestamp'] <= last_broadcasts[0]['timestamp']:
+            raise LocalComposeError('feed timestamps not monotonically increasing')
+
+def validate_cancel(params):
+    filters = [('tx_hash', '==', params['offer_hash'])]
+    offers = sum(util.api_batch([
+        ('get_orders', {'filters': filters}),
+        ('get_bets', {'filters': filters}),
+        ('get_rps', {'filters': filters})
+    ]), [])
+    if not offers:
+        raise LocalComposeError('no open offer with hash {}'.format(params['offer_hash']))
+    if offers[0]['source'] != params['source']:
+        raise LocalComposeError('incorrect source address')
+    if offers[0]['status'] != 'open':
+        raise LocalComposeError('offer not open')
+
+def validate_order(params):
+    check_quantity(params, 'give_quantity')
+    check_quantity(params, 'get_quantity')
+    for name in ('expiration', 'fee_required'):
+        value = params.get(name)
+        if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= MAX_INT:
+            raise LocalComposeError('invalid {}'.format(name))
+    if params['expiration'] > config.MAX_EXPIRATION:
+        raise LocalComposeError('expiration overflow')
+    check_assets([params['give_asset'], params['get_asset']])
+    balances, = util.api_batch([get_balance_call(params['source'], params['give_asset'])])
+    check_balance(balances, params['source'], params['give_asset'], params['give_quantity'])
+
+VALIDATORS = {
+    'send': validate_send,
+    'broadcast': validate_broadcast,
+    'cancel': validate_cancel,
+    'order': validate_order
+}
+
+PACKERS = {
+    'send': pack_send,
+    'broadcast': pack_broadcast,
+    'cancel': pack_cancel,
+    'order': pack_order
+}
+
+def var_int(i):
+    if i < 0xfd:
+        return bytes([i])
+    elif i <= 0xffff:
+        return b'\xfd' + struct.pack('<H', i)
+    return b'\xfe' + struct.pack('<I', i)
+
+def push_data(data):
+    if len(data) <= 75:
+        return bytes([len(data)]) + data
+    return b'\x4c' + bytes([len(data)]) + data
+
+# Unsigned transaction, with the previous output script in the script of each input.
+def serialise(inputs, outputs):
+    s = struct.pack('<I', 1)
+    s += var_int(len(inputs))
+    for txin in inputs:
+        script = binascii.unhexlify(txin['scriptPubKey'])
+        s += binascii.unhexlify(txin['txid'])[::-1] + struct.pack('<I', txin['vout'])
+        s += var_int(len(script)) + script
+        s += b'\xff\xff\xff\xff'
+    s += var_int(len(outputs))
+    for script, value in outputs:
+        s += struct.pack('<Q', value) + var_int(len(script)) + script
+    s += struct.pack('<I', 0)
+    return s
+
+def get_fee(params, inputs, outputs):
+    from unopartycli import messages
+    if params.get('fee'):
+        return params['fee']
+    # Same estimate as `messages.check_transaction`, with a change output.
+    unsigned_size = len(serialise(inputs, outputs + [(binascii.unhexlify(inputs[0]['scriptPubKey']), 0)]))
+    signed_size = unsigned_size - sum(len(txin['scriptPubKey']) // 2 for txin in inputs) + len(inputs) * messages.SIGNED_INPUT_SCRIPT_SIZE
+    fee_per_kb = params.get('fee_per_kb') or config.DEFAULT_FEE_PER_KB
+    return ceil(signed_size * fee_per_kb / 1000)
+
+def select_inputs(source, params, outputs, utxo_allocator=None):
+    outputs_value = sum(value for script, value in outputs)
+    placeholder = [{'txid': '00' * 32, 'vout': 0, 'scriptPubKey': '76a914' + '00' * 20 + '88ac'}]
+    min_value = outputs_value + get_fee(params, placeholder, outputs)
+    for i in range(MAX_INPUT_SELECTION_TRIES):
+        if utxo_allocator is not None:
+            try:
+                inputs = utxo_allocator.reserve(source, min_value)
+            except utxos.UTXOAllocationError as e:
+                raise LocalComposeError(str(e))
+        else:
+            unspents = [output for output in wallet.list_unspent() if output['address'] == source]
+            if not params.get('allow_unconfirmed_inputs'):
+                unspents = [output for output in unspents if output.get('confirmations', 0) > 0]
+            inputs = utxos.select_outputs(unspents, min_value)
+
+        if not inputs or any(not signing.is_p2pkh(binascii.unhexlify(txin['scriptPubKey'])) for txin in inputs):
+            if utxo_allocator is not None:
+                utxo_allocator.release([utxos.outpoint(txin) for txin in inputs])
+            raise LocalComposeError('no pay-to-pubkey-hash inputs available for {}'.format(source))
+
+        inputs_value = sum(util.to_satoshis(txin['amount']) for txin in inputs)
+        fee = get_fee(params, inputs, outputs)
+        if inputs_value >= outputs_value + fee:
+            return inputs, inputs_value - outputs_value - fee
+
+        if utxo_allocator is not None:
+            utxo_allocator.release([utxos.outpoint(txin) for txin in inputs])
+        if inputs_value < min_value:
+            raise LocalComposeError('insufficient {} at address {}'.format(config.BTC, source))
+        min_value = outputs_value + fee + 1
+
+    raise LocalComposeError('could not select inputs for {}'.format(source))
+
+def compose(message_name, params, utxo_allocator=None):
+    """
+        Build the unsigned transaction of a `send`, `broadcast`, `cancel` or `order`
+        message with the parameters of the corresponding `create_*` method.
+    """
+    if message_name not in PACKERS:
+        raise LocalComposeError('{} messages are composed by the server'.format(message_name))
+    if params.get('encoding', 'auto') not in ('auto', 'opreturn'):
+        raise LocalComposeError('only the opreturn encoding is composed locally')
+    if not util.validate_address(params['source']):
+        raise LocalComposeError('source is not a mono-sig address')
+
+    block_index = get_block_index()
+    data = PACKERS[message_name](params, block_index)
+    VALIDATORS[message_name](params)
+    data = config.PREFIX + data
+    if len(data) > config.OP_RETURN_MAX_SIZE:
+        raise LocalComposeError('message too long for an OP_RETURN output')
+
+    op_return_value = params.get('op_return_value', config.DEFAULT_OP_RETURN_VALUE)
+    # Placeholder data of the same size, until the first input (the ARC4 key) is known.
+    outputs = [(b'\x6a' + push_data(data), op_return_value)]
+    inputs, change = select_inputs(params['source'], params, outputs, utxo_allocator=utxo_allocator)
+
+    regular_dust_size = params.get('regular_dust_size', config.DEFAULT_REGULAR_DUST_SIZE)
+    if 0 < change < regular_dust_size:
+        # The server would add it to the fee, above the estimate.
+        if utxo_allocator is not None:
+            utxo_allocator.release([utxos.outpoint(txin) for txin in inputs])
+        raise LocalComposeError('change below dust size')
+
+    key = arc4.init_arc4(binascii.unhexlify(inputs[0]['txid']))
+    outputs = [(b'\x6a' + push_data(key.encrypt(data)), op_return_value)]
+    if change:
+        outputs.append((binascii.unhexlify(inputs[0]['scriptPubKey']), change))
+
+    return binascii.hexlify(serialise(inputs, outputs)).decode('ascii')
+
+# Compare a locally composed transaction with the server's, on what the protocol reads from them.
+# Raises `LocalComposeError` if they differ.
+def check_with_server(method, params, unsigned_tx_hex):
+    server_tx_hex = util.api(method, dict(params, disable_utxo_locks=True))
+    local_info, server_info = util.api_batch([
+        ('get_tx_info', {'tx_hex': unsigned_tx_hex}),
+        ('get_tx_info', {'tx_hex': server_tx_hex})
+    ])
+    # source, destination, btc_amount and data; the fee depends on the inputs.
+    if [local_info[i] for i in (0, 1, 2, 4)] != [server_info[i] for i in (0, 1, 2, 4)]:
+        logger.warning('Locally composed {} differs from the server: {} != {}'.format(method, local_info, server_info))
+        raise LocalComposeError('locally composed transaction differs from the server')
+
+def should_check():
+    check_rate = getattr(config, 'LOCAL_COMPOSE_CHECK_RATE', 0)
+    return check_rate > 0 and random.random() < check_rate
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -1,7 +1,53 @@
-import os
-from prettytable import PrettyTable
+import sys
+import csv
+import time
+import logging
+import itertools
+import collections
+import concurrent.futures
+from unopartylib.lib import config
 from unopartycli import wallet, util
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXPORT_RANGE_SIZE = 10000 # blocks
+DEFAULT_EXPORT_JOBS = 4
+DEFAULT_EXPORT_RETRIES = 3
+EXPORT_RETRY_DELAY = 2 # seconds
+TABLE_SAMPLE_SIZE = 1000
+DEFAULT_GETROWS_LIMIT = 100
+
+# Unique, ordered column that `getrows --all` pages on by default. Other tables are paged by offset.
+PAGE_KEYS = {
+    'blocks': 'block_index',
+    'transactions': 'tx_index',
+    'messages': 'message_index',
+    'bets': 'tx_index',
+    'broadcasts': 'tx_index',
+    'btcpays': 'tx_index',
+    'burns': 'tx_index',
+    'cancels': 'tx_index',
+    'destructions': 'tx_index',
+    'dispensers': 'tx_index',
+    'dividends': 'tx_index',
+    'issuances': 'tx_index',
+    'orders': 'tx_index',
+    'rps': 'tx_index',
+    'rpsresolves': 'tx_index',
+    'sends': 'tx_index',
+    'sweeps': 'tx_index',
+    'bet_expirations': 'bet_index',
+    'order_expirations': 'order_index',
+    'rps_expirations': 'rps_index'
+}
+
+OUTPUT_FORMATS = ['pretty', 'json', 'compact', 'ndjson', 'csv', 'msgpack']
+
+class ExportError(Exception):
+    pass
+class OutputError(Exception):
+    pass
+
 # TODO: inelegant
 def get_view(view_name, args):
     if view_name == 'balances':
@@ -18,89 +64,267 @@ def get_view(view_name, args):
         return util.api('get_tx_info', {'tx_hex': args.tx_hex})
     elif view_name == 'getrows':
         method = 'get_{}'.format(args.table)
-        if args.filter:
-            filters = [tuple(f) for f in args.filter]
+        return util.api(method, getrows_params(args))
+
+def getrows_params(args):
+    if args.filter:
+        filters = [tuple(f) for f in args.filter]
+    else:
+        filters = []
+    return {
+        'filters': filters,
+        'filterop': args.filter_op,
+        'order_by': args.order_by,
+        'order_dir': args.order_dir,
+        'start_block': args.start_block,
+        'end_block': args.end_block,
+        'status': args.status,
+        'limit': DEFAULT_GETROWS_LIMIT if args.limit is None else args.limit,
+        'offset': args.offset
+    }
+
+# Rows ordered by `key`, one page at a time: each page starts at the last `key` of the previous one
+# (rows already yielded with that value are skipped), so that new rows don't shift the pages.
+def keyset_rows(method, params, key, page_size=util.API_PAGE_SIZE):
+    comparison = '<=' if params.get('order_dir') == 'DESC' else '>='
+    params = dict(params, order_by=key, limit=page_size)
+    page = util.api(method, params)
+    boundary = []
+    while True:
+        for row in page:
+            if row not in boundary:
+                yield row
+        if len(page) < page_size:
+            break
+        last = page[-1][key]
+        boundary = [row for row in page if row[key] == last]
+        if len(boundary) == len(page):
+            raise ExportError('At least {} rows with {} = {}; order by a more selective column.'.format(page_size, key, last))
+        page = util.api(method, dict(params, filters=params['filters'] + [(key, comparison, last)], offset=0))
+
+# The rows of `getrows` from `--offset` on (at most `--limit` if given), fetched one page at a time
+# as they are consumed, in the order of `--order-by` (by default the unique index of the table, if known).
+def stream_getrows(args):
+    method = 'get_{}'.format(args.table)
+    params = getrows_params(args)
+    key = args.order_by or PAGE_KEYS.get(args.table)
+    if key is None:
+        rows = util.api_rows(method, params)
+    elif params['filters'] and params['filterop'] == 'OR':
+        # The key filter can't be combined with the others: page by offset.
+        rows = util.api_rows(method, dict(params, order_by=key))
+    else:
+        rows = keyset_rows(method, params, key)
+    if args.limit is not None:
+        rows = itertools.islice(rows, int(args.limit))
+    return rows
+
+class RowWriter:
+    """Write rows as they come, in NDJSON or CSV (with the columns of the first row)."""
+
+    def __init__(self, output_format, fp):
+        self.output_format = output_format
+        self.fp = fp
+        self.csv_writer = None
+
+    def write(self, row):
+        if self.output_format == 'csv':
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.fp, fieldnames=list(row.keys()), extrasaction='ignore', lineterminator='\n')
+                self.csv_writer.writeheader()
+            # Nested values are written as JSON.
+            self.csv_writer.writerow(dict((key, util.json_dump_compact(value) if isinstance(value, (dict, list)) else value) for key, value in row.items()))
         else:
-            filters = []
-        params = {
-            'filters': filters,
-            'filterop': args.filter_op,
-            'order_by': args.order_by,
-            'order_dir': args.order_dir,
-            'start_block': args.start_block,
-            'end_block': args.end_block,
-            'status': args.status,
-            'limit': args.limit,
-            'offset': args.offset
-        }
-        return util.api(method, params)
+            self.fp.write(util.json_dump_compact(row) + '\n')
+
+def write_rows(rows, output_format, fp):
+    writer = RowWriter(output_format, fp)
+    for row in rows:
+        writer.write(row)
+
+def msgpack_default(o):
+    if isinstance(o, util.D):
+        return str(o)
+    raise TypeError('Cannot serialize {!r}'.format(o))
+
+def write_output(view, output_format, fp=None):
+    """
+        Write a view in a machine-readable format: `json` (indented), `compact` (JSON on
+        one line), `ndjson` or `csv` (one line per item of a list) or `msgpack`.
+    """
+    fp = fp or sys.stdout
+    if output_format == 'json':
+        fp.write(util.json_dump(view) + '\n')
+    elif output_format == 'compact':
+        fp.write(util.json_dump_compact(view) + '\n')
+    elif output_format in ('ndjson', 'csv'):
+        rows = view if isinstance(view, list) else [view]
+        if output_format == 'csv' and not all(isinstance(row, dict) for row in rows):
+            rows = [{'value': row} for row in rows]
+        write_rows(rows, output_format, fp)
+    elif output_format == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            raise OutputError('The msgpack output requires the `msgpack` package.')
+        fp.flush()
+        fp.buffer.write(msgpack.packb(view, default=msgpack_default, use_bin_type=True))
+        fp.buffer.flush()
+    else:
+        raise OutputError('Unknown output format: {}'.format(output_format))
+
+def block_ranges(start_block, end_block, range_size):
+    for first in range(start_block, end_block + 1, range_size):
+        yield first, min(first + range_size - 1, end_block)
+
+def fetch_block_range(method, params, first, last, retries):
+    params = dict(params, start_block=first, end_block=last, offset=0)
+    for attempt in range(retries + 1):
+        try:
+            return list(util.api_rows(method, params))
+        except Exception as e:
+            if attempt == retries:
+                raise ExportError('Blocks {}-{} failed after {} tries: {}'.format(first, last, retries + 1, e))
+            logger.debug('Blocks {}-{} failed ({}); retrying.'.format(first, last, e))
+            time.sleep(EXPORT_RETRY_DELAY * (attempt + 1))
+
+def print_progress(done, total, rows, fp):
+    width = 30
+    filled = int(width * done / total) if total else width
+    fp.write('\r[{}{}] {}/{} ranges, {} rows'.format('#' * filled, '-' * (width - filled), done, total, rows))
+    if done == total:
+        fp.write('\n')
+    fp.flush()
+
+def export_getrows(args, fp, progress=None):
+    """
+        Write all the rows of `getrows` between `--start-block` and `--end-block` (the last
+        block by default) to `fp`, in block order. The span is split into `--range-size`
+        block ranges fetched concurrently by `--jobs` workers; a failed range is retried
+        `--retries` times on its own.
+    """
+    method = 'get_{}'.format(args.table)
+    params = getrows_params(args)
+    params['order_by'] = args.order_by or 'block_index'
+    params['order_dir'] = args.order_dir or 'ASC'
+    start_block = int(args.start_block or config.BLOCK_FIRST)
+    if args.end_block:
+        end_block = int(args.end_block)
+    else:
+        end_block = util.api('get_running_info')['last_block']['block_index']
+    ranges = list(block_ranges(start_block, end_block, args.range_size))
+    if params['order_dir'] == 'DESC':
+        ranges.reverse()
+
+    writer = RowWriter(args.format, fp)
+    counts = {'ranges': 0, 'rows': 0}
+    def write_range(future):
+        for row in future.result():
+            writer.write(row)
+            counts['rows'] += 1
+        counts['ranges'] += 1
+        if progress is not None:
+            print_progress(counts['ranges'], len(ranges), counts['rows'], progress)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        pending = collections.deque()
+        for first, last in ranges:
+            pending.append(executor.submit(fetch_block_range, method, params, first, last, args.retries))
+            # Write the ranges in order, reading ahead a few ranges only to bound memory.
+            while len(pending) >= args.jobs * 2 or (pending and pending[0].done()):
+                write_range(pending.popleft())
+        while pending:
+            write_range(pending.popleft())
+    return counts['rows']
+
+def justify(text, width, align):
+    if align == 'l':
+        return text.ljust(width)
+    excess = width - len(text)
+    # Like PrettyTable: uneven padding goes right of odd-length texts, left of even-length ones.
+    if excess % 2 and len(text) % 2 == 0:
+        return ' ' * (excess // 2 + 1) + text + ' ' * (excess // 2)
+    return ' ' * (excess // 2) + text + ' ' * (excess - excess // 2)
+
+def write_table(rows, field_names=None, align='c', fp=None):
+    """
+        Write `rows` (lists of values) as a text table in the PrettyTable layout,
+        line by line rather than rendered into one string. Column widths come from
+        every row of a list, and from the first `TABLE_SAMPLE_SIZE` rows of an
+        iterator, the other rows being written as they are read (wider values
+        overflow their column).
+    """
+    fp = fp or sys.stdout
+    if isinstance(rows, (list, tuple)):
+        sample, rows = rows, []
+    else:
+        rows = iter(rows)
+        sample = list(itertools.islice(rows, TABLE_SAMPLE_SIZE))
+
+    widths = [len(str(name)) for name in field_names] if field_names else []
+    for row in sample:
+        for i, value in enumerate(row):
+            if i < len(widths):
+                widths[i] = max(widths[i], len(str(value)))
+            else:
+                widths.append(len(str(value)))
+
+    border = '+' + '+'.join('-' * (width + 2) for width in widths) + '+\n'
+    def line(values):
+        return '| ' + ' | '.join(justify(str(value), width, align) for value, width in zip(values, widths)) + ' |\n'
+
+    fp.write(border)
+    if field_names:
+        fp.write(line(field_names))
+        fp.write(border)
+    for row in itertools.chain(sample, rows):
+        fp.write(line(row))
+    fp.write(border)
 
 def print_balances(balances):
-    lines = []
-    lines.append('')
-    lines.append('Address Balances')
-    table = PrettyTable(['Asset', 'Amount'])
-    for asset in balances:
-        table.add_row([asset, balances[asset]])
-    lines.append(table.get_string())
-    lines.append('')
-    print(os.linesep.join(lines))
+    print('')
+    print('Address Balances')
+    write_table([[asset, balances[asset]] for asset in balances], ['Asset', 'Amount'])
+    print('')
 
 def print_asset(asset):
-    lines = []
-    lines.append('')
-    lines.append('Asset Details')
-    table = PrettyTable(header=False, align='l')
-    table.add_row(['Asset Name:', asset['asset']])
-    table.add_row(['Asset ID:', asset['asset_id']])
-    table.add_row(['Divisible:', asset['divisible']])
-    table.add_row(['Locked:', asset['locked']])
-    table.add_row(['Supply:', asset['supply']])
-    table.add_row(['Issuer:', asset['issuer']])
-    table.add_row(['Description:', '‘' + asset['description'] + '’'])
-    table.add_row(['Balance:', asset['balance']])
-    lines.append(table.get_string())
+    print('')
+    print('Asset Details')
+    write_table([
+        ['Asset Name:', asset['asset']],
+        ['Asset ID:', asset['asset_id']],
+        ['Divisible:', asset['divisible']],
+        ['Locked:', asset['locked']],
+        ['Supply:', asset['supply']],
+        ['Issuer:', asset['issuer']],
+        ['Description:', '‘' + asset['description'] + '’'],
+        ['Balance:', asset['balance']]
+    ], align='l')
 
     if asset['addresses']:
-        lines.append('')
-        lines.append('Wallet Balances')
-        table = PrettyTable(['Address', 'Balance'])
-        for address in asset['addresses']:
-            balance = asset['addresses'][address]
-            table.add_row([address, balance])
-        lines.append(table.get_string())
+        print('')
+        print('Wallet Balances')
+        write_table([[address, asset['addresses'][address]] for address in asset['addresses']], ['Address', 'Balance'])
 
     if asset['sends']:
-        lines.append('')
-        lines.append('Wallet Sends and Receives')
-        table = PrettyTable(['Type', 'Quantity', 'Source', 'Destination'])
-        for send in asset['sends']:
-            table.add_row([send['type'], send['quantity'], send['source'], send['destination']])
-        lines.append(table.get_string())
+        print('')
+        print('Wallet Sends and Receives')
+        write_table([[send['type'], send['quantity'], send['source'], send['destination']] for send in asset['sends']], ['Type', 'Quantity', 'Source', 'Destination'])
 
-    lines.append('')
-    print(os.linesep.join(lines))
+    print('')
 
 def print_wallet(wallet):
-    lines = [] 
     for address in wallet['addresses']:
-        table = PrettyTable(['Asset', 'Balance'])
-        for asset in wallet['addresses'][address]:
-            balance = wallet['addresses'][address][asset]
-            table.add_row([asset, balance])
-        lines.append(address)
-        lines.append(table.get_string())
-        lines.append('')
-    total_table = PrettyTable(['Asset', 'Balance'])
-    for asset in wallet['assets']:
-        balance = wallet['assets'][asset]
-        total_table.add_row([asset, balance])
-    lines.append('TOTAL')
-    lines.append(total_table.get_string())
-    lines.append('')
-    print(os.linesep.join(lines))
+        balances = wallet['addresses'][address]
+        print(address)
+        write_table([[asset, balances[asset]] for asset in balances], ['Asset', 'Balance'])
+        print('')
+    print('TOTAL')
+    write_table([[asset, wallet['assets'][asset]] for asset in wallet['assets']], ['Asset', 'Balance'])
+    print('')
 
 def print_pending(awaiting_btcs):
+    from prettytable import PrettyTable
     table = PrettyTable(['Matched Order ID', 'Time Left'])
     for order_match in awaiting_btcs:
         order_match = format_order_match(order_match)
@@ -110,11 +334,7 @@ def print_pending(awaiting_btcs):
 def print_getrows(rows):
     if len(rows) > 0:
         headers = list(rows[0].keys())
-        table = PrettyTable(headers)
-        for row in rows:
-            values = list(row.values())
-            table.add_row(values)
-        print(table)
+        write_table([list(row.values()) for row in rows], headers)
     else:
         print("No result.")
 
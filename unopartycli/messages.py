@@ -4,15 +4,14 @@ import binascii
 from math import ceil
 import time
 import calendar
-import dateutil.parser
+import threading
 
-from unopartylib.lib import script, config, blocks, exceptions, api, transaction
+from unopartylib.lib import script, config, exceptions
 from unopartylib.lib.util import make_id, BET_TYPE_NAME, BET_TYPE_ID, dhash, generate_asset_name
 from unopartylib.lib.kickstart.utils import ib2h
 from unopartycli import util
 from unopartycli import wallet
-
-import bitcoin as bitcoinlib
+from unopartycli import utxos
 
 MESSAGE_PARAMS = {
     'send': ['source', 'destination', 'asset', 'quantity', 'memo', 'memo_is_hex', 'use_enhanced_send'],
@@ -33,6 +32,14 @@ MESSAGE_PARAMS = {
     'destroy': ['source', 'asset', 'quantity', 'tag']
 }
 
+# Arguments naming the assets whose divisibility is needed to convert quantities.
+MESSAGE_ASSETS = {
+    'send': ['asset'],
+    'dispenser': ['asset'],
+    'order': ['give_asset', 'get_asset'],
+    'destroy': ['asset']
+}
+
 class InputError(Exception):
     pass
 class ArgumentError(Exception):
@@ -46,51 +53,116 @@ def input_pubkey(address):
     input_message = 'Public keys (hexadecimal) or Private key (Wallet Import Format) for `{}`: '.format(address)
     return input(input_message)
 
-def get_pubkey_monosig(pubkeyhash, pubkey_resolver=input_pubkey):
-    if wallet.is_valid(pubkeyhash):
-
-        # If in wallet, get from wallet.
-        logging.debug('Looking for public key for `{}` in wallet.'.format(pubkeyhash))
-        if wallet.is_mine(pubkeyhash):
-            pubkey = wallet.get_pubkey(pubkeyhash)
-            if pubkey:
-                return pubkey
-        logging.debug('Public key for `{}` not found in wallet.'.format(pubkeyhash))
-
-        # If in blockchain (and not in wallet), get from blockchain.
-        logging.debug('Looking for public key for `{}` in blockchain.'.format(pubkeyhash))
-        try:
-            pubkey = util.api('search_pubkey', {'pubkeyhash': pubkeyhash, 'provided_pubkeys': None})
-        except util.RPCError as e:
-            pubkey = None
+def get_wallet_pubkey(pubkeyhash):
+    logging.debug('Looking for public key for `{}` in wallet.'.format(pubkeyhash))
+    if wallet.is_mine(pubkeyhash):
+        pubkey = wallet.get_pubkey(pubkeyhash)
         if pubkey:
             return pubkey
-        logging.debug('Public key for `{}` not found in blockchain.'.format(pubkeyhash))
+    logging.debug('Public key for `{}` not found in wallet.'.format(pubkeyhash))
+    return None
 
-        # If not in wallet and not in blockchain, get from user.
-        answer = pubkey_resolver(pubkeyhash)
-        if not answer:
-            return None
+# Public keys of pubkeyhashes (they never change), persisted in the user data dir
+# and shared by every client process.
+known_pubkeys = None
+known_pubkeys_lock = threading.Lock()
+
+def pubkey_matches(pubkeyhash, pubkey):
+    try:
+        pubkey_bytes = binascii.unhexlify(pubkey)
+        if pubkeyhash == script.pubkey_to_pubkeyhash(pubkey_bytes):
+            return True
+        return hasattr(script, 'pubkey_to_p2whash') and pubkeyhash == script.pubkey_to_p2whash(pubkey_bytes)
+    except Exception:
+        return False
+
+# The cache file may have been edited or corrupted: only the keys matching their address are used.
+def load_known_pubkeys():
+    cached = util.read_cache_file('pubkeys')
+    if not isinstance(cached, dict):
+        return {}
+    verified = dict((pubkeyhash, pubkey) for pubkeyhash, pubkey in cached.items() if isinstance(pubkey, str) and pubkey_matches(pubkeyhash, pubkey))
+    if len(verified) < len(cached):
+        logging.warning('Ignoring {} public keys not matching their address in the cache.'.format(len(cached) - len(verified)))
+    return verified
+
+def get_known_pubkeys(pubkeyhashes):
+    global known_pubkeys
+    with known_pubkeys_lock:
+        if known_pubkeys is None:
+            known_pubkeys = load_known_pubkeys()
+        return dict((pubkeyhash, known_pubkeys[pubkeyhash]) for pubkeyhash in pubkeyhashes if pubkeyhash in known_pubkeys)
+
+def remember_pubkeys(pubkeys):
+    global known_pubkeys
+    # Only keep the keys which really hash to their address.
+    verified = dict((pubkeyhash, pubkey) for pubkeyhash, pubkey in pubkeys.items() if pubkey and pubkey_matches(pubkeyhash, pubkey))
+    with known_pubkeys_lock:
+        if known_pubkeys is None:
+            known_pubkeys = load_known_pubkeys()
+        verified = dict((pubkeyhash, pubkey) for pubkeyhash, pubkey in verified.items() if known_pubkeys.get(pubkeyhash) != pubkey)
+        if verified:
+            known_pubkeys.update(verified)
+            util.write_cache_file('pubkeys', known_pubkeys)
+
+# Look for several public keys in blockchain with a single batched request.
+def search_pubkeys(pubkeyhashes):
+    for pubkeyhash in pubkeyhashes:
+        logging.debug('Looking for public key for `{}` in blockchain.'.format(pubkeyhash))
+    calls = [('search_pubkey', {'pubkeyhash': pubkeyhash, 'provided_pubkeys': None}) for pubkeyhash in pubkeyhashes]
+    try:
+        results = util.api_batch(calls, return_errors=True)
+    except util.RPCError as e:
+        results = [e] * len(calls)
+    pubkeys = {}
+    for pubkeyhash, pubkey in zip(pubkeyhashes, results):
+        if isinstance(pubkey, util.RPCError) or not pubkey:
+            logging.debug('Public key for `{}` not found in blockchain.'.format(pubkeyhash))
+            pubkey = None
+        pubkeys[pubkeyhash] = pubkey
+    return pubkeys
 
-        # Public Key or Private Key?
-        is_fully_valid_pubkey = True
+def resolve_pubkey(pubkeyhash, pubkey_resolver=input_pubkey):
+    # If not in wallet and not in blockchain, get from user.
+    answer = pubkey_resolver(pubkeyhash)
+    if not answer:
+        return None
+
+    # Public Key or Private Key?
+    is_fully_valid_pubkey = True
+    try:
+        is_fully_valid_pubkey = script.is_fully_valid(binascii.unhexlify(answer))
+    except binascii.Error:
+        is_fully_valid_pubkey = False
+    if is_fully_valid_pubkey:
+        logging.debug('Answer was a fully valid public key.')
+        pubkey = answer
+    else:
+        logging.debug('Answer was not a fully valid public key. Assuming answer was a private key.')
+        private_key = answer
         try:
-            is_fully_valid_pubkey = script.is_fully_valid(binascii.unhexlify(answer))
-        except binascii.Error:
-            is_fully_valid_pubkey = False
-        if is_fully_valid_pubkey:
-            logging.debug('Answer was a fully valid public key.')
-            pubkey = answer
-        else:
-            logging.debug('Answer was not a fully valid public key. Assuming answer was a private key.')
-            private_key = answer
-            try:
-                pubkey = script.private_key_to_public_key(private_key)
-            except script.AltcoinSupportError:
-                raise InputError('invalid private key')
-        if pubkeyhash != script.pubkey_to_pubkeyhash(binascii.unhexlify(bytes(pubkey, 'utf-8'))):
-            raise InputError('provided public or private key does not match the source address')
+            pubkey = script.private_key_to_public_key(private_key)
+        except script.AltcoinSupportError:
+            raise InputError('invalid private key')
+    if pubkeyhash != script.pubkey_to_pubkeyhash(binascii.unhexlify(bytes(pubkey, 'utf-8'))):
+        raise InputError('provided public or private key does not match the source address')
 
+    return pubkey
+
+def get_pubkey_monosig(pubkeyhash, pubkey_resolver=input_pubkey):
+    if wallet.is_valid(pubkeyhash):
+
+        # If already resolved once, get from cache.
+        pubkey = get_known_pubkeys([pubkeyhash]).get(pubkeyhash)
+        if pubkey:
+            return pubkey
+
+        # If in wallet, get from wallet; if in blockchain (and not in wallet), get from blockchain.
+        pubkey = get_wallet_pubkey(pubkeyhash) or search_pubkeys([pubkeyhash])[pubkeyhash]
+        if not pubkey:
+            pubkey = resolve_pubkey(pubkeyhash, pubkey_resolver=pubkey_resolver)
+        if pubkey:
+            remember_pubkeys({pubkeyhash: pubkey})
         return pubkey
 
     return None
@@ -99,10 +171,20 @@ def get_pubkeys(address, pubkey_resolver=input_pubkey):
     pubkeys = []
     if script.is_multisig(address):
         _, pubs, _ = script.extract_array(address)
+        pubs = [pub for pub in pubs if wallet.is_valid(pub)]
+        found = get_known_pubkeys(pubs)
+        missing = [pub for pub in pubs if pub not in found]
+        if missing:
+            wallet.prefetch_addresses_info(missing)
+            for pub in missing:
+                found[pub] = get_wallet_pubkey(pub)
+            # Search all the keys missing from wallet in one request.
+            found.update(search_pubkeys([pub for pub in missing if not found[pub]]))
         for pub in pubs:
-            pubkey = get_pubkey_monosig(pub, pubkey_resolver=pubkey_resolver)
-            if pubkey:
-                pubkeys.append(pubkey)
+            found[pub] = found[pub] or resolve_pubkey(pub, pubkey_resolver=pubkey_resolver)
+            if found[pub]:
+                pubkeys.append(found[pub])
+        remember_pubkeys(dict((pub, found[pub]) for pub in missing))
     else:
         pubkey = get_pubkey_monosig(address, pubkey_resolver=pubkey_resolver)
         if pubkey:
@@ -129,13 +211,17 @@ def prepare_args(args, action):
     args.multisig_dust_size = int(args.multisig_dust_size * config.UNIT)
     args.op_return_value = int(args.op_return_value * config.UNIT)
 
+    # Resolve every asset involved with a single request.
+    assets = [getattr(args, asset_arg) for asset_arg in MESSAGE_ASSETS.get(action, [])]
+    divisibilities = util.get_divisibilities(assets)
+
     # common
     if args.fee:
         args.fee = util.value_in(args.fee, config.BTC)
 
     # send
     if action == 'send':
-        args.quantity = util.value_in(args.quantity, args.asset)
+        args.quantity = util.value_in(args.quantity, args.asset, divisible=divisibilities[args.asset])
 
     # sweep
     if action == 'sweep':
@@ -144,8 +230,8 @@ def prepare_args(args, action):
     # dispenser
     if action == 'dispenser':
         args.status = int(args.status)
-        args.give_quantity = util.value_in(args.give_quantity, args.asset)
-        args.escrow_quantity = util.value_in(args.escrow_quantity, args.asset)
+        args.give_quantity = util.value_in(args.give_quantity, args.asset, divisible=divisibilities[args.asset])
+        args.escrow_quantity = util.value_in(args.escrow_quantity, args.asset, divisible=divisibilities[args.asset])
         args.mainchainrate = util.value_in(args.mainchainrate, config.BTC)
 
     # order
@@ -168,8 +254,8 @@ def prepare_args(args, action):
             args.fee_required = 0
             args.fee_provided = 0
 
-        args.give_quantity = util.value_in(give_quantity, args.give_asset)
-        args.get_quantity = util.value_in(get_quantity, args.get_asset)
+        args.give_quantity = util.value_in(give_quantity, args.give_asset, divisible=divisibilities[args.give_asset])
+        args.get_quantity = util.value_in(get_quantity, args.get_asset, divisible=divisibilities[args.get_asset])
 
     # issuance
     if action == 'issuance':
@@ -183,6 +269,7 @@ def prepare_args(args, action):
 
     # bet
     if action == 'bet':
+        import dateutil.parser
         args.deadline = calendar.timegm(dateutil.parser.parse(args.deadline).utctimetuple())
         args.wager = util.value_in(args.wager, config.XCP)
         args.counterwager = util.value_in(args.counterwager, config.XCP)
@@ -205,7 +292,7 @@ def prepare_args(args, action):
 
     # destroy
     if action == 'destroy':
-        args.quantity = util.value_in(args.quantity, args.asset)
+        args.quantity = util.value_in(args.quantity, args.asset, divisible=divisibilities[args.asset])
 
     # RPS
     if action == 'rps':
@@ -231,39 +318,143 @@ def extract_args(args, keys):
             params[key] = dargs[key]
     return params
 
-def get_input_value(tx_hex):
-    unspents = wallet.list_unspent()
-    ctx = bitcoinlib.core.CTransaction.deserialize(binascii.unhexlify(tx_hex))
+# Upper bound of the size of a signed pay-to-pubkey-hash input script (signature and
+# uncompressed public key), used to estimate the size of the signed transaction from the unsigned one.
+SIGNED_INPUT_SCRIPT_SIZE = 1 + 73 + 1 + 65
+SIGNATURE_PUSH_SIZE = 1 + 73
+
+def get_input_value(ctx):
+    outpoints = [(ib2h(vin.prevout.hash), vin.prevout.n) for vin in ctx.vin]
+    amounts = wallet.get_output_amounts(outpoints)
 
     inputs_value = 0
-    for vin in ctx.vin:
-        vin_tx_hash = ib2h(vin.prevout.hash)
-        vout_n = vin.prevout.n
-        found = False
-        for output in unspents:
-            if output['txid'] == vin_tx_hash and output['vout'] == vout_n:
-                inputs_value += int(output['amount'] * config.UNIT)
-                found = True
-        if not found:
+    for outpoint in outpoints:
+        if outpoint not in amounts:
             raise exceptions.TransactionError('input not found in wallet list unspents')
+        inputs_value += amounts[outpoint]
 
     return inputs_value
 
+# Upper bound of the size of the signed script of an input, from the previous output script
+# that the unsigned transaction holds in its place. `None` for scripts whose spending size
+# is unknown, like pay-to-script-hash.
+def signed_input_script_size(script_pubkey):
+    if len(script_pubkey) == 25 and script_pubkey[:3] == b'\x76\xa9\x14' and script_pubkey[23:] == b'\x88\xac':
+        return SIGNED_INPUT_SCRIPT_SIZE
+    if len(script_pubkey) in (35, 67) and script_pubkey[-1:] == b'\xac':
+        # Pay-to-pubkey: a signature.
+        return SIGNATURE_PUSH_SIZE
+    if len(script_pubkey) > 3 and script_pubkey[-1:] == b'\xae' and 0x51 <= script_pubkey[0] <= 0x60:
+        # Bare multisig: OP_0 and `m` signatures.
+        return 1 + (script_pubkey[0] - 0x50) * SIGNATURE_PUSH_SIZE
+    if len(script_pubkey) == 22 and script_pubkey[:2] == b'\x00\x14':
+        # Pay-to-witness-pubkey-hash: an empty script, and a witness (item count, signature and
+        # compressed public key) counted for a quarter of its size, plus the segwit marker and flag.
+        return ceil((1 + SIGNATURE_PUSH_SIZE + 1 + 33) / 4) + 1
+    return None
+
+def estimate_signed_size(ctx, unsigned_size):
+    signed_scripts_size = 0
+    for vin in ctx.vin:
+        script_size = signed_input_script_size(bytes(vin.scriptSig))
+        if script_size is None:
+            return None
+        signed_scripts_size += script_size - len(vin.scriptSig)
+    return unsigned_size + signed_scripts_size
+
+# Value can only leave the source as change, as the quantity of a send of the native coin
+# or of a burn, or as dust (data and destination outputs).
+def check_outputs(method, params, ctx):
+    if method == 'create_btcpay':
+        # The amount owed to the counterparty is only known to the server.
+        return
+    source_script = util.address_script(params['source']) if not script.is_multisig(params['source']) else None
+    if source_script is None:
+        logging.debug('Cannot check the outputs of a transaction from {}.'.format(params['source']))
+        return
+
+    allowed = {}
+    if method == 'create_send' and params.get('asset') == config.BTC:
+        allowed[util.address_script(params['destination'])] = params['quantity']
+    elif method == 'create_burn':
+        allowed[util.address_script(config.UNSPENDABLE)] = params['quantity']
+    dust_size = max(params.get('regular_dust_size') or config.DEFAULT_REGULAR_DUST_SIZE,
+                    params.get('multisig_dust_size') or config.DEFAULT_MULTISIG_DUST_SIZE)
+
+    for vout in ctx.vout:
+        script_pubkey = bytes(vout.scriptPubKey)
+        if script_pubkey == source_script or script_pubkey[:1] == b'\x6a' or vout.nValue <= dust_size:
+            continue
+        if allowed.get(script_pubkey) == vout.nValue:
+            del allowed[script_pubkey]
+            continue
+        raise exceptions.TransactionError('Unexpected output: {} paid to {}'.format(vout.nValue, binascii.hexlify(script_pubkey).decode('ascii')))
+
+# Verify an unsigned transaction; it is deserialized once and shared by every stage.
 def check_transaction(method, params, tx_hex):
-    tx_info = transaction.check_outputs(method, params, tx_hex)
-    input_value = get_input_value(tx_hex)
-    fee = input_value - tx_info['total_value']
+    import bitcoin as bitcoinlib
+
+    timings = []
+    def stage(name, start):
+        timings.append('{} {:.1f}ms'.format(name, (time.time() - start) * 1000))
+        return time.time()
+
+    start = time.time()
+    tx_bytes = binascii.unhexlify(tx_hex)
+    ctx = bitcoinlib.core.CTransaction.deserialize(tx_bytes)
+    start = stage('parse', start)
+
+    check_outputs(method, params, ctx)
+    output_value = sum(vout.nValue for vout in ctx.vout)
+    start = stage('outputs', start)
+
+    input_value = get_input_value(ctx)
+    start = stage('inputs', start)
+
+    fee = input_value - output_value
     fee_per_kb = params['fee_per_kb'] if 'fee_per_kb' in params else config.DEFAULT_FEE_PER_KB
 
     if 'fee' in params and params['fee']:
         necessary_fee = params['fee']
     else:
-        necessary_fee = ceil(((len(tx_hex) / 2) / 1024)) * fee_per_kb # TODO
-
-    if fee > necessary_fee:
+        signed_size = estimate_signed_size(ctx, len(tx_bytes))
+        if signed_size is None:
+            necessary_fee = None
+        else:
+            # Servers charge either per started kilobyte or linearly in the size: allow the larger. The
+            # server also adds change below the dust size to the fee.
+            regular_dust_size = params.get('regular_dust_size') or config.DEFAULT_REGULAR_DUST_SIZE
+            necessary_fee = (signed_size // 1000 + 1) * fee_per_kb + regular_dust_size
+            if method == 'create_order':
+                # Orders giving the native coin add the provided fee to the transaction fee.
+                necessary_fee += params.get('fee_provided') or 0
+    stage('fee', start)
+    logging.debug('Transaction check: {}.'.format(', '.join(timings)))
+
+    if necessary_fee is None:
+        logging.debug('Fee not checked: unknown input script types.')
+    elif fee > necessary_fee:
         raise exceptions.TransactionError('Incorrect fee ({} > {})'.format(fee, necessary_fee))
 
-def compose_transaction(args, message_name, param_names):
+# Returns `None` when the message has to be composed by the server.
+def compose_locally(method, message_name, params, utxo_allocator=None):
+    from unopartycli import composer
+
+    if message_name not in composer.LOCAL_MESSAGES:
+        return None
+    unsigned_tx_hex = None
+    try:
+        unsigned_tx_hex = composer.compose(message_name, params, utxo_allocator=utxo_allocator)
+        if composer.should_check():
+            composer.check_with_server(method, params, unsigned_tx_hex)
+    except composer.LocalComposeError as e:
+        logging.debug('Composing {} on the server: {}.'.format(message_name, e))
+        if utxo_allocator is not None and unsigned_tx_hex is not None:
+            utxo_allocator.release(utxos.transaction_outpoints(utxos.parse_transaction(unsigned_tx_hex)))
+        return None
+    return unsigned_tx_hex
+
+def compose_transaction(args, message_name, param_names, pubkey_resolver=input_pubkey, utxo_allocator=None):
     args = prepare_args(args, message_name)
     common_params = common_args(args)
     params = extract_args(args, param_names)
@@ -275,20 +466,34 @@ def compose_transaction(args, message_name, param_names):
         if address_name in params:
             address = params[address_name]
             if not script.is_p2sh(address) and (script.is_multisig(address) or address_name != 'destination'):    # We don’t need the pubkey for a mono‐sig destination.
-                pubkeys += get_pubkeys(address)
+                pubkeys += get_pubkeys(address, pubkey_resolver=pubkey_resolver)
     params['pubkey'] = pubkeys
 
     method = 'create_{}'.format(message_name)
-    unsigned_tx_hex = util.api(method, params)
+    unsigned_tx_hex = None
+    if config.LOCAL_COMPOSE:
+        unsigned_tx_hex = compose_locally(method, message_name, params, utxo_allocator=utxo_allocator)
+    if unsigned_tx_hex is None:
+        if utxo_allocator is None:
+            unsigned_tx_hex = util.api(method, params)
+        else:
+            # Inputs are picked by the allocator, among those not reserved by other composes.
+            unsigned_tx_hex = utxo_allocator.compose(method, params)
 
-    # check_transaction(method, params, unsigned_tx_hex)
+    if config.CHECK_TRANSACTIONS:
+        try:
+            check_transaction(method, params, unsigned_tx_hex)
+        except Exception:
+            if utxo_allocator is not None:
+                utxo_allocator.release(utxos.transaction_outpoints(utxos.parse_transaction(unsigned_tx_hex)))
+            raise
 
     return unsigned_tx_hex
 
-def compose(message, args):
+def compose(message, args, pubkey_resolver=input_pubkey, utxo_allocator=None):
     if message in MESSAGE_PARAMS:
         param_names = MESSAGE_PARAMS[message]
-        return compose_transaction(args, message, param_names)
+        return compose_transaction(args, message, param_names, pubkey_resolver=pubkey_resolver, utxo_allocator=utxo_allocator)
     else:
         raise ArgumentError('Invalid message name')
 
@@ -55,7 +55,7 @@ def extract_old_config():
     old_configfile = os.path.join(old_appdir, 'unopartyd.conf')
 
     if os.path.exists(old_configfile):
-        configfile = configparser.SafeConfigParser(allow_no_value=True, inline_comment_prefixes=('#', ';'))
+        configfile = configparser.ConfigParser(allow_no_value=True, inline_comment_prefixes=('#', ';'))
         configfile.read(old_configfile)
         if 'Default' in configfile:
             for key in configfile['Default']:
@@ -139,22 +139,26 @@ def server_to_client_config(server_config):
     return client_config
 
 def generate_config_files():
-    from unopartycli.server import CONFIG_ARGS as SERVER_CONFIG_ARGS
-    from unopartycli.client import CONFIG_ARGS as CLIENT_CONFIG_ARGS
-    from unopartylib.lib import config, util
+    from unopartylib.lib import config
 
     configdir = appdirs.user_config_dir(appauthor=config.XCP_NAME, appname=config.APP_NAME, roaming=True)
 
     server_configfile = os.path.join(configdir, 'server.conf')
-    if not os.path.exists(server_configfile):
-        # extract known configuration
-        server_known_config = get_server_known_config()
-        generate_config_file(server_configfile, SERVER_CONFIG_ARGS, server_known_config)
-
-        client_configfile = os.path.join(configdir, 'client.conf')
-        if not os.path.exists(client_configfile):
-            client_known_config = server_to_client_config(server_known_config)
-            generate_config_file(client_configfile, CLIENT_CONFIG_ARGS, client_known_config)
+    if os.path.exists(server_configfile):
+        # Nothing to do: checked before importing the server, which is slow to import.
+        return
+
+    from unopartycli.server import CONFIG_ARGS as SERVER_CONFIG_ARGS
+    from unopartycli.client import CONFIG_ARGS as CLIENT_CONFIG_ARGS
+
+    # extract known configuration
+    server_known_config = get_server_known_config()
+    generate_config_file(server_configfile, SERVER_CONFIG_ARGS, server_known_config)
+
+    client_configfile = os.path.join(configdir, 'client.conf')
+    if not os.path.exists(client_configfile):
+        client_known_config = server_to_client_config(server_known_config)
+        generate_config_file(client_configfile, CLIENT_CONFIG_ARGS, client_known_config)
 
 def zip_folder(folder_path, zip_path):
     zip_file = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
@@ -0,0 +1,109 @@
+import ctypes
+import ctypes.util
+import logging
+logger = logging.getLogger(__name__)
+
+# ECDSA signing backends used for local signing (`wallet.pycoin_sign_raw_transaction`).
+# Both produce the same low-S, RFC6979 deterministic signatures.
+
+SECP256K1_CONTEXT_SIGN = (1 << 0) | (1 << 9)
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+
+class SigningBackendError(Exception):
+    pass
+
+class PycoinBackend:
+    name = 'pycoin'
+
+    def sign(self, secret_exponent, sighash):
+        from pycoin.ecdsa import generator_secp256k1, sign
+        from pycoin.tx.script.der import sigencode_der
+        r, s = sign(generator_secp256k1, secret_exponent, sighash)
+        if s + s > SECP256K1_ORDER:
+            s = SECP256K1_ORDER - s
+        return sigencode_der(r, s)
+
+class Secp256k1Backend:
+    name = 'libsecp256k1'
+
+    def __init__(self, library_path=None):
+        library_path = library_path or ctypes.util.find_library('secp256k1')
+        if not library_path:
+            raise SigningBackendError('libsecp256k1 not found')
+        try:
+            lib = ctypes.cdll.LoadLibrary(library_path)
+        except OSError as e:
+            raise SigningBackendError('Cannot load libsecp256k1: {}'.format(e))
+
+        lib.secp256k1_context_create.argtypes = [ctypes.c_uint]
+        lib.secp256k1_context_create.restype = ctypes.c_void_p
+        # A NULL nonce function selects the default RFC6979 one.
+        lib.secp256k1_ecdsa_sign.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_void_p]
+        lib.secp256k1_ecdsa_sign.restype = ctypes.c_int
+        lib.secp256k1_ecdsa_signature_serialize_der.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t), ctypes.c_char_p]
+        lib.secp256k1_ecdsa_signature_serialize_der.restype = ctypes.c_int
+
+        self.lib = lib
+        self.context = lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN)
+        if not self.context:
+            raise SigningBackendError('Cannot create libsecp256k1 context')
+
+    def sign(self, secret_exponent, sighash):
+        signature = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_sign(self.context, signature, sighash.to_bytes(32, 'big'), secret_exponent.to_bytes(32, 'big'), None, None):
+            raise SigningBackendError('libsecp256k1 failed to sign')
+        der = ctypes.create_string_buffer(72)
+        der_length = ctypes.c_size_t(72)
+        self.lib.secp256k1_ecdsa_signature_serialize_der(self.context, der, ctypes.byref(der_length), signature)
+        return der.raw[:der_length.value]
+
+backend = None
+
+def load_backend(name='auto'):
+    if name == 'pycoin':
+        return PycoinBackend()
+    elif name == 'libsecp256k1':
+        return Secp256k1Backend()
+    elif name == 'auto':
+        try:
+            return Secp256k1Backend()
+        except SigningBackendError as e:
+            logger.debug('{}; signing with pycoin.'.format(e))
+            return PycoinBackend()
+    else:
+        raise SigningBackendError('Unknown signing backend: {}'.format(name))
+
+def set_backend(name):
+    global backend
+    backend = load_backend(name)
+
+def get_backend():
+    global backend
+    if backend is None:
+        backend = load_backend()
+    return backend
+
+def is_p2pkh(script):
+    return len(script) == 25 and script[:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac'
+
+def push_data(data):
+    return bytes([len(data)]) + data
+
+# Sign the `idx` input of a pycoin `Tx` whose script holds the previous output script.
+# Pay-to-pubkey-hash inputs are signed with the selected backend (pycoin or libsecp256k1); other
+# scripts are left to pycoin's `Tx.sign_tx_in`.
+def sign_tx_in(tx, idx, hash160_lookup, hash_type):
+    from pycoin.encoding import public_pair_to_sec
+
+    tx_in = tx.txs_in[idx]
+    signing_backend = get_backend()
+    if not is_p2pkh(tx_in.script) or tx_in.script[3:23] not in hash160_lookup:
+        tx.sign_tx_in(hash160_lookup, idx, tx_in.script, hash_type=hash_type)
+        return
+
+    secret_exponent, public_pair, compressed = hash160_lookup[tx_in.script[3:23]]
+    sighash = tx.signature_hash(tx_in.script, idx, hash_type)
+    signature = signing_backend.sign(secret_exponent, sighash) + bytes([hash_type])
+    tx_in.script = push_data(signature) + push_data(public_pair_to_sec(public_pair, compressed))
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
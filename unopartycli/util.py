@@ -11,26 +11,28 @@ import requests
 import collections
 import logging
 import binascii
-from datetime import datetime
-from dateutil.tz import tzlocal
 import argparse
 import configparser
 import appdirs
 import tarfile
 import urllib.request
 import shutil
-import codecs
 import tempfile
+import copy
+import hashlib
 
 logger = logging.getLogger(__name__)
 
 D = decimal.Decimal
 
-from unopartylib import server
-from unopartylib.lib import config, check
+from unopartylib.lib import config
 from unopartylib.lib.util import value_input, value_output
 
+DEFAULT_RPC_POOL_SIZE = 10
+
+# One `requests.Session` per endpoint, shared by all threads.
 rpc_sessions = {}
+rpc_sessions_lock = threading.Lock()
 
 class JsonDecimalEncoder(json.JSONEncoder):
     def default(self, o):
@@ -40,26 +42,55 @@ class JsonDecimalEncoder(json.JSONEncoder):
 
 json_dump = lambda x: json.dumps(x, sort_keys=True, indent=4, cls=JsonDecimalEncoder)
 json_print = lambda x: print(json_dump(x))
+# Without indentation `json.dumps` uses the C encoder, which still calls `default()` for each Decimal.
+json_dump_compact = lambda x: json.dumps(x, separators=(',', ':'), cls=JsonDecimalEncoder)
 
 class RPCError(Exception):
     pass
 class AssetError(Exception):
     pass
 
-def rpc(url, method, params=None, ssl_verify=False, tries=1):
+def get_rpc_session(url):
+    with rpc_sessions_lock:
+        if url not in rpc_sessions:
+            pool_size = getattr(config, 'RPC_POOL_SIZE', DEFAULT_RPC_POOL_SIZE)
+            # Block instead of opening throwaway connections when every pooled one is busy,
+            # so that concurrent callers keep reusing the same keep-alive connections.
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            rpc_session = requests.Session()
+            rpc_session.mount('http://', adapter)
+            rpc_session.mount('https://', adapter)
+            rpc_sessions[url] = rpc_session
+        return rpc_sessions[url]
+
+def rpc_session_stats():
+    stats = {}
+    with rpc_sessions_lock:
+        for url, rpc_session in rpc_sessions.items():
+            requests_count, connections_count = 0, 0
+            pools = rpc_session.get_adapter(url).poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                requests_count += pool.num_requests
+                connections_count += pool.num_connections
+            # Hide credentials.
+            endpoint = re.sub('//[^/@]*@', '//', url)
+            stats[endpoint] = {
+                'requests': requests_count,
+                'connections': connections_count,
+                'reused': max(requests_count - connections_count, 0)
+            }
+    return stats
+
+def close_rpc_sessions():
+    with rpc_sessions_lock:
+        for rpc_session in rpc_sessions.values():
+            rpc_session.close()
+        rpc_sessions.clear()
+
+def rpc_post(url, payload, ssl_verify=False, tries=1):
     headers = {'content-type': 'application/json'}
-    payload = {
-        "method": method,
-        "params": params,
-        "jsonrpc": "2.0",
-        "id": 0,
-    }
-
-    if url not in rpc_sessions:
-        rpc_session = requests.Session()
-        rpc_sessions[url] = rpc_session
-    else:
-    	rpc_session = rpc_sessions[url]
+    rpc_session = get_rpc_session(url)
 
     response = None
     for i in range(tries):
@@ -81,29 +112,555 @@ def rpc(url, method, params=None, ssl_verify=False, tries=1):
     elif response.status_code not in (200, 500):
         raise RPCError(str(response.status_code) + ' ' + response.reason + ' ' + response.text)
 
-    # Return result, with error handling.
-    response_json = response.json()
+    return response.json()
+
+def rpc(url, method, params=None, ssl_verify=False, tries=1):
+    payload = {
+        "method": method,
+        "params": params,
+        "jsonrpc": "2.0",
+        "id": 0,
+    }
+    response_json = rpc_post(url, payload, ssl_verify=ssl_verify, tries=tries)
+    return rpc_result(response_json)
+
+# Return result, with error handling.
+def rpc_result(response_json):
     if 'error' not in response_json.keys() or response_json['error'] == None:
         return response_json['result']
     else:
         raise RPCError('{}'.format(response_json['error']))
 
+# Send several calls in one JSON-RPC 2.0 batch request.
+# `calls` is a list of `(method, params)` tuples; results are returned in the same order.
+# If `return_errors` is set, a failed call yields an `RPCError` instance in its slot
+# instead of raising.
+def rpc_batch(url, calls, ssl_verify=False, tries=1, return_errors=False):
+    if not calls:
+        return []
+
+    payload = []
+    for call_id, (method, params) in enumerate(calls):
+        payload.append({
+            "method": method,
+            "params": params,
+            "jsonrpc": "2.0",
+            "id": call_id,
+        })
+    response_json = rpc_post(url, payload, ssl_verify=ssl_verify, tries=tries)
+
+    # A server that rejects the whole batch answers with a single error object.
+    if isinstance(response_json, dict):
+        raise RPCError('{}'.format(response_json.get('error', response_json)))
+
+    responses = {}
+    for response in response_json:
+        responses[response.get('id')] = response
+
+    results = []
+    for call_id, (method, params) in enumerate(calls):
+        if call_id not in responses:
+            error = RPCError('No response for `{}` (id {}).'.format(method, call_id))
+        elif 'error' in responses[call_id] and responses[call_id]['error'] != None:
+            error = RPCError('{}'.format(responses[call_id]['error']))
+        else:
+            results.append(responses[call_id]['result'])
+            continue
+        if not return_errors:
+            raise error
+        results.append(error)
+    return results
+
+# Read-only server methods whose results can only change when a new block is parsed.
+API_CACHE_METHODS = ['get_balances', 'get_issuances', 'get_assets', 'get_supply', 'get_asset_info']
+API_CACHE_BLOCK_CHECK_INTERVAL = 2 # seconds
+
+class APICache:
+    """LRU cache of server responses, flushed when the server parses a new block."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size # bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.last_block = None
+        self.last_block_check = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def key(self, method, params):
+        return json.dumps([method, params], sort_keys=True, cls=JsonDecimalEncoder)
+
+    def update_block(self, running_info):
+        last_block = running_info.get('last_block') if isinstance(running_info, dict) else None
+        if isinstance(last_block, dict):
+            last_block = (last_block.get('block_index'), last_block.get('block_hash'))
+        with self.lock:
+            self.last_block_check = time.time()
+            if last_block != self.last_block:
+                if self.entries:
+                    logger.debug('New block {}; flushing API cache.'.format(last_block))
+                    self.invalidations += 1
+                self.entries.clear()
+                self.size = 0
+                self.generation += 1
+                self.last_block = last_block
+
+    def check_block(self):
+        if time.time() - self.last_block_check >= API_CACHE_BLOCK_CHECK_INTERVAL:
+            self.update_block(rpc(config.UNOPARTY_RPC, 'get_running_info', ssl_verify=config.UNOPARTY_RPC_SSL_VERIFY))
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # Callers are free to modify their results.
+                return True, copy.deepcopy(self.entries[key][0])
+            self.misses += 1
+            return False, None
+
+    def put(self, key, result, generation):
+        size = len(json.dumps(result, cls=JsonDecimalEncoder))
+        with self.lock:
+            # Drop results fetched before the last block change.
+            if generation != self.generation or size > self.max_size:
+                return
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (copy.deepcopy(result), size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def call(self, method, params):
+        self.check_block()
+        key = self.key(method, params)
+        found, result = self.get(key)
+        if found:
+            return result
+        generation = self.generation
+        result = rpc(config.UNOPARTY_RPC, method, params=params, ssl_verify=config.UNOPARTY_RPC_SSL_VERIFY)
+        self.put(key, result, generation)
+        return result
+
+    def call_batch(self, calls, return_errors=False):
+        self.check_block()
+        results = [None] * len(calls)
+        misses = []
+        for i, (method, params) in enumerate(calls):
+            if method in API_CACHE_METHODS:
+                found, result = self.get(self.key(method, params))
+                if found:
+                    results[i] = result
+                    continue
+            misses.append(i)
+        generation = self.generation
+        miss_results = rpc_batch(config.UNOPARTY_RPC, [calls[i] for i in misses], ssl_verify=config.UNOPARTY_RPC_SSL_VERIFY, return_errors=return_errors)
+        for i, result in zip(misses, miss_results):
+            results[i] = result
+            method, params = calls[i]
+            if method in API_CACHE_METHODS and not isinstance(result, RPCError):
+                self.put(self.key(method, params), result, generation)
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'last_block': self.last_block
+            }
+
+api_cache = None
+
+def enable_api_cache(max_size):
+    global api_cache
+    if max_size:
+        api_cache = APICache(max_size)
+    else:
+        api_cache = None
+
+def api_cache_stats():
+    if api_cache is None:
+        return None
+    return api_cache.stats()
+
 def api(method, params=None):
-    return rpc(config.UNOPARTY_RPC, method, params=params, ssl_verify=config.UNOPARTY_RPC_SSL_VERIFY)
+    if api_cache is not None:
+        if method in API_CACHE_METHODS:
+            return api_cache.call(method, params)
+    result = rpc(config.UNOPARTY_RPC, method, params=params, ssl_verify=config.UNOPARTY_RPC_SSL_VERIFY)
+    if api_cache is not None and method == 'get_running_info':
+        api_cache.update_block(result)
+    return result
+
+def api_batch(calls, return_errors=False):
+    if api_cache is not None:
+        return api_cache.call_batch(calls, return_errors=return_errors)
+    return rpc_batch(config.UNOPARTY_RPC, calls, ssl_verify=config.UNOPARTY_RPC_SSL_VERIFY, return_errors=return_errors)
+
+# Server default for `--api-limit-rows`.
+API_PAGE_SIZE = 1000
+
+# Iterate over all the rows returned by a `get_{table}` method, one page at a time.
+def api_rows(method, params, page_size=API_PAGE_SIZE):
+    offset = int(params.get('offset') or 0)
+    while True:
+        page = api(method, dict(params, limit=page_size, offset=offset))
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            break
+        offset += page_size
 
 def wallet_api(method, params=None):
     return rpc(config.WALLET_URL, method, params=params, ssl_verify=config.WALLET_SSL_VERIFY)
 
+def wallet_api_batch(calls, return_errors=False):
+    return rpc_batch(config.WALLET_URL, calls, ssl_verify=config.WALLET_SSL_VERIFY, return_errors=return_errors)
+
+UTXO_SNAPSHOT_BLOCK_CHECK_INTERVAL = 2 # seconds
+
+class UTXOSnapshot:
+    """
+        Unspent outputs of a wallet, indexed by address and by outpoint, reloaded when the wallet sees a new block.
+        `on_reload` is called after each reload.
+    """
+
+    def __init__(self, list_unspent, wallet_last_block, on_reload=None):
+        self.list_unspent_func = list_unspent
+        self.wallet_last_block_func = wallet_last_block
+        self.on_reload = on_reload
+        self.lock = threading.Lock()
+        self.unspents = None
+        self.by_address = collections.OrderedDict()
+        self.by_outpoint = {}
+        self.last_block = None
+        self.last_block_check = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.unspents = None
+
+    def refresh(self):
+        # Must be called with the lock held.
+        if self.unspents is not None and time.time() - self.last_block_check < UTXO_SNAPSHOT_BLOCK_CHECK_INTERVAL:
+            return
+        last_block = self.wallet_last_block_func()
+        self.last_block_check = time.time()
+        if self.unspents is not None and last_block == self.last_block:
+            return
+
+        logger.debug('Loading UTXO snapshot at block {}.'.format(last_block))
+        unspents = self.list_unspent_func()
+        by_address = collections.OrderedDict()
+        by_outpoint = {}
+        for output in unspents:
+            by_address.setdefault(output['address'], []).append(output)
+            by_outpoint[(output['txid'], output['vout'])] = output
+        self.unspents, self.by_address, self.by_outpoint = unspents, by_address, by_outpoint
+        self.last_block = last_block
+        if self.on_reload is not None:
+            self.on_reload()
+
+    def is_loaded(self):
+        with self.lock:
+            return self.unspents is not None
+
+    def list_unspent(self):
+        with self.lock:
+            self.refresh()
+            return self.unspents
+
+    def addresses(self):
+        with self.lock:
+            self.refresh()
+            return list(self.by_address.keys())
+
+    def balances(self):
+        with self.lock:
+            self.refresh()
+            return [(address, sum(output['amount'] for output in outputs)) for address, outputs in self.by_address.items()]
+
+    def balance(self, address):
+        with self.lock:
+            self.refresh()
+            return sum(output['amount'] for output in self.by_address.get(address, []))
+
+    def get_output(self, txid, vout):
+        with self.lock:
+            self.refresh()
+            return self.by_outpoint.get((txid, vout))
+
+    # Amounts, in satoshis, of the `(txid, vout)` outpoints found in the snapshot.
+    # Returns nothing if the snapshot isn't loaded yet, rather than downloading it.
+    def get_output_amounts(self, outpoints):
+        amounts = {}
+        with self.lock:
+            if self.unspents is None:
+                return amounts
+            self.refresh()
+            for outpoint in outpoints:
+                output = self.by_outpoint.get(outpoint)
+                if output is not None:
+                    amounts[outpoint] = to_satoshis(output['amount'])
+        return amounts
+
+ADDRESS_INFO_CACHE_SIZE = 10000
+ADDRESS_INFO_TTL = 60 # seconds
+
+class AddressInfoCache:
+    """
+        Wallet `validateaddress` results, which serve `is_valid`, `is_mine` and `get_pubkey`.
+
+        At most `max_size` addresses are kept, for `ttl` seconds at most; `clear` drops
+        them all when the wallet changes (the wallet backends call it on new blocks).
+    """
+
+    def __init__(self, max_size=ADDRESS_INFO_CACHE_SIZE, ttl=ADDRESS_INFO_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # address -> (expiry, address info)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, addresses):
+        now = time.time()
+        infos = {}
+        with self.lock:
+            for address in set(addresses):
+                if address in self.entries and self.entries[address][0] > now:
+                    self.entries.move_to_end(address)
+                    infos[address] = self.entries[address][1]
+
+        missing = [address for address in set(addresses) if address not in infos]
+        if not missing:
+            return [infos[address] for address in addresses]
+        elif len(missing) == 1:
+            results = [wallet_api('validateaddress', [missing[0]])]
+        else:
+            results = wallet_api_batch([('validateaddress', [address]) for address in missing])
+
+        expiry = time.time() + self.ttl
+        with self.lock:
+            for address, address_info in zip(missing, results):
+                infos[address] = address_info
+                self.entries[address] = (expiry, address_info)
+                self.entries.move_to_end(address)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return [infos[address] for address in addresses]
+
+address_info_cache = AddressInfoCache()
+
+# Default maximum number of host parameters in a single SQLite statement.
+SQLITE_MAX_VARIABLES = 999
+
+def chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# With `network=False`, the cache is shared by all networks (and can be used before they are configured).
+def cache_file_path(name, network=True):
+    data_dir = appdirs.user_data_dir(appauthor=config.XCP_NAME, appname=config.APP_NAME, roaming=True)
+    if network:
+        if config.TESTNET:
+            name += '.testnet'
+        elif config.CUSTOMNET:
+            # Custom networks are told apart by their unspendable address.
+            name += '.customnet-{}'.format(config.UNSPENDABLE)
+        elif config.REGTEST:
+            name += '.regtest'
+        if config.TESTCOIN:
+            name += '.testcoin'
+    return os.path.join(data_dir, 'client.{}.json'.format(name))
+
+def read_cache_file(name, network=True):
+    cache_file = cache_file_path(name, network=network)
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r', encoding='utf8') as fp:
+            return json.load(fp)
+    except (OSError, ValueError) as e:
+        logger.debug('Ignoring unreadable cache file `{}`: {}'.format(cache_file, e))
+        return {}
+
+def write_cache_file(name, data, network=True):
+    cache_file = cache_file_path(name, network=network)
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, mode=0o755)
+        # Write to a temporary file first, so that concurrent clients never read a partial file.
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix='.client.', suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf8') as fp:
+            json.dump(data, fp)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.debug('Could not write cache file `{}`: {}'.format(cache_file, e))
+
+# Divisibility of assets (it never changes after the first issuance), persisted in the user data dir.
+asset_divisibility = None
+asset_divisibility_lock = threading.Lock()
+
+def get_divisibilities(assets):
+    global asset_divisibility
+
+    divisibilities = {}
+    missing = []
+    with asset_divisibility_lock:
+        if asset_divisibility is None:
+            asset_divisibility = read_cache_file('asset_info')
+        for asset in set(assets):
+            if asset in (config.BTC, config.XCP, 'leverage', 'value', 'fraction', 'price', 'odds'):
+                divisibilities[asset] = True
+            elif asset in asset_divisibility:
+                divisibilities[asset] = asset_divisibility[asset]
+            else:
+                missing.append(asset)
+
+    if missing:
+        found = {}
+        # Keep one binding for `status`.
+        for chunk in chunks(sorted(missing), SQLITE_MAX_VARIABLES - 1):
+            sql = '''SELECT DISTINCT asset, divisible FROM issuances WHERE (status = ? AND asset IN ({}))'''.format(','.join(['?'] * len(chunk)))
+            bindings = ['valid'] + chunk
+            for issuance in api('sql', {'query': sql, 'bindings': bindings}):
+                found[issuance['asset']] = issuance['divisible']
+
+        if found:
+            with asset_divisibility_lock:
+                asset_divisibility.update(found)
+                write_cache_file('asset_info', asset_divisibility)
+            divisibilities.update(found)
+
+        for asset in missing:
+            if asset not in found:
+                raise AssetError('No such asset: {}'.format(asset))
+
+    return divisibilities
+
 def is_divisible(asset):
-    if asset in (config.BTC, config.XCP, 'leverage', 'value', 'fraction', 'price', 'odds'):
-        return True
+    return get_divisibilities([asset])[asset]
+
+B58_DIGITS = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+
+def base58_check_decode(address):
+    n = 0
+    for char in address:
+        digit = B58_DIGITS.find(char)
+        if digit == -1:
+            raise ValueError('invalid base58 character')
+        n = n * 58 + digit
+    data = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    # Leading '1's encode leading zero bytes.
+    pad = len(address) - len(address.lstrip(B58_DIGITS[0]))
+    data = b'\x00' * pad + data
+    if len(data) < 5:
+        raise ValueError('base58 data too short')
+    payload, checksum = data[:-4], data[-4:]
+    if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+        raise ValueError('invalid base58 checksum')
+    return payload
+
+def bech32_polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    checksum = 1
+    for value in values:
+        top = checksum >> 25
+        checksum = (checksum & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            checksum ^= generator[i] if ((top >> i) & 1) else 0
+    return checksum
+
+def bech32_decode(address):
+    if address.lower() != address and address.upper() != address:
+        raise ValueError('mixed case bech32 address')
+    address = address.lower()
+    pos = address.rfind('1')
+    if pos < 1 or pos + 7 > len(address) or len(address) > 90:
+        raise ValueError('invalid bech32 separator position')
+    hrp = address[:pos]
+    data = []
+    for char in address[pos + 1:]:
+        if char not in BECH32_CHARSET:
+            raise ValueError('invalid bech32 character')
+        data.append(BECH32_CHARSET.find(char))
+    hrp_expanded = [ord(char) >> 5 for char in hrp] + [0] + [ord(char) & 31 for char in hrp]
+    if bech32_polymod(hrp_expanded + data) != 1:
+        raise ValueError('invalid bech32 checksum')
+    data = data[:-6]
+    if not data or data[0] > 16:
+        raise ValueError('invalid witness version')
+    # Convert the witness program from 5-bit to 8-bit groups.
+    acc, bits, program = 0, 0, []
+    for value in data[1:]:
+        acc = (acc << 5) | value
+        bits += 5
+        while bits >= 8:
+            bits -= 8
+            program.append((acc >> bits) & 0xff)
+    if bits >= 5 or (acc << (8 - bits)) & 0xff:
+        raise ValueError('invalid bech32 padding')
+    if len(program) < 2 or len(program) > 40 or (data[0] == 0 and len(program) not in (20, 32)):
+        raise ValueError('invalid witness program length')
+    return hrp, data[0], bytes(program)
+
+# Output script paying a mono-sig address, or `None` if it can't be built offline.
+def address_script(address):
+    try:
+        payload = base58_check_decode(address)
+    except ValueError:
+        pass
     else:
-        sql = '''SELECT * FROM issuances WHERE (status = ? AND asset = ?)'''
-        bindings = ['valid', asset]
-        issuances = api('sql', {'query': sql, 'bindings': bindings})
+        if payload[:len(config.ADDRESSVERSION)] == config.ADDRESSVERSION:
+            return b'\x76\xa9\x14' + payload[len(config.ADDRESSVERSION):] + b'\x88\xac'
+        if payload[:len(config.P2SH_ADDRESSVERSION)] == config.P2SH_ADDRESSVERSION:
+            return b'\xa9\x14' + payload[len(config.P2SH_ADDRESSVERSION):] + b'\x87'
+        return None
+    try:
+        hrp, witness_version, witness_program = bech32_decode(address)
+    except ValueError:
+        return None
+    return bytes([witness_version + 0x50 if witness_version else 0, len(witness_program)]) + witness_program
+
+# Validate a mono-sig address without asking the wallet.
+# Returns `None` when it can't be decided offline: the bech32 prefix of the network isn't known
+# to the client, so the wallet checks bech32 addresses with a valid checksum.
+def validate_address(address):
+    try:
+        payload = base58_check_decode(address)
+    except ValueError:
+        pass
+    else:
+        for version in (config.ADDRESSVERSION, config.P2SH_ADDRESSVERSION):
+            if payload[:len(version)] == version and len(payload) == len(version) + 20:
+                return True
+        return False
+
+    try:
+        bech32_decode(address)
+    except ValueError:
+        return False
+    return None
 
-        if not issuances: raise AssetError('No such asset: {}'.format(asset))
-        return issuances[0]['divisible']
+# Convert an amount of BTC returned by the wallet (float) to an integer number of satoshis.
+def to_satoshis(amount):
+    return int(round(D(str(amount)) * config.UNIT))
 
 def value_in(quantity, asset, divisible=None):
     if divisible is None:
@@ -116,6 +673,8 @@ def value_out(quantity, asset, divisible=None):
     return value_output(quantity, asset, divisible)
 
 def bootstrap(testnet=False, overwrite=True, ask_confirmation=False, quiet=False):
+    from unopartylib.lib import check
+
     data_dir = appdirs.user_data_dir(appauthor=config.XCP_NAME, appname=config.APP_NAME, roaming=True)
 
     # Set Constants. - Needs changing here
@@ -167,6 +726,20 @@ def bootstrap(testnet=False, overwrite=True, ask_confirmation=False, quiet=False
     os.remove(TARBALL_PATH)
     os.remove(os.path.join(data_dir, 'checksums.txt'))
 
+def config_boolean(value):
+    if value is None or value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+        raise ValueError('Not a boolean: {}'.format(value))
+    return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+# Values of the `Default` section of a config file. It is only read: `utf-8-sig` skips the BOM
+# some editors add.
+def read_config_file(config_file):
+    logger.debug('Loading configuration file: `{}`'.format(config_file))
+    configfile = configparser.ConfigParser(allow_no_value=True, inline_comment_prefixes=('#', ';'))
+    with open(config_file, 'r', encoding='utf-8-sig') as fp:
+        configfile.read_file(fp)
+    return dict(configfile['Default']) if 'Default' in configfile else {}
+
 # Set default values of command line arguments with config file
 def add_config_arguments(arg_parser, config_args, default_config_file, config_file_arg_name='config_file'):
     cmd_args = arg_parser.parse_known_args()[0]
@@ -178,39 +751,16 @@ def add_config_arguments(arg_parser, config_args, default_config_file, config_fi
             os.makedirs(config_dir, mode=0o755)
         config_file = os.path.join(config_dir, default_config_file)
 
-    # clean BOM
-    BUFSIZE = 4096
-    BOMLEN = len(codecs.BOM_UTF8)
-    with codecs.open(config_file, 'r+b') as fp:
-        chunk = fp.read(BUFSIZE)
-        if chunk.startswith(codecs.BOM_UTF8):
-            i = 0
-            chunk = chunk[BOMLEN:]
-            while chunk:
-                fp.seek(i)
-                fp.write(chunk)
-                i += len(chunk)
-                fp.seek(BOMLEN, os.SEEK_CUR)
-                chunk = fp.read(BUFSIZE)
-            fp.seek(-BOMLEN, os.SEEK_CUR)
-            fp.truncate()
-
-    logger.debug('Loading configuration file: `{}`'.format(config_file))
-    configfile = configparser.SafeConfigParser(allow_no_value=True, inline_comment_prefixes=('#', ';'))
-    with codecs.open(config_file, 'r', encoding='utf8') as fp:
-        configfile.readfp(fp)
-
-    if not 'Default' in configfile:
-        configfile['Default'] = {}
+    values = read_config_file(config_file)
 
     # Initialize default values with the config file.
     for arg in config_args:
         key = arg[0][-1].replace('--', '')
-        if 'action' in arg[1] and arg[1]['action'] == 'store_true' and key in configfile['Default']:
-            arg[1]['default'] = configfile['Default'].getboolean(key)
-        elif key in configfile['Default'] and configfile['Default'][key]:
-            arg[1]['default'] = configfile['Default'][key]
-        elif key in configfile['Default'] and arg[1].get('nargs', '') == '?' and 'const' in arg[1]:
+        if 'action' in arg[1] and arg[1]['action'] == 'store_true' and key in values:
+            arg[1]['default'] = config_boolean(values[key])
+        elif key in values and values[key]:
+            arg[1]['default'] = values[key]
+        elif key in values and arg[1].get('nargs', '') == '?' and 'const' in arg[1]:
             arg[1]['default'] = arg[1]['const']  # bit of a hack
         arg_parser.add_argument(*arg[0], **arg[1])
 
@@ -0,0 +1,184 @@
+import time
+import logging
+import binascii
+import threading
+import collections
+
+from unopartylib.lib import config
+from unopartylib.lib.kickstart.utils import ib2h
+from unopartycli import util, wallet
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESERVATION_TTL = 600 # seconds
+MAX_COMPOSE_TRIES = 8
+
+class UTXOAllocationError(Exception):
+    pass
+
+def outpoint(output):
+    return (output['txid'], output['vout'])
+
+def parse_transaction(tx_hex):
+    import bitcoin as bitcoinlib
+    return bitcoinlib.core.CTransaction.deserialize(binascii.unhexlify(tx_hex))
+
+def transaction_outpoints(ctx):
+    return [(ib2h(vin.prevout.hash), vin.prevout.n) for vin in ctx.vin]
+
+def is_insufficient_error(e):
+    return 'Insufficient' in str(e)
+
+# Rough lower bound, in satoshis, of the inputs needed by a `create_*` call: the fee,
+# a dust output and a change output, plus the quantity of a send of the native coin.
+def estimate_min_value(method, params):
+    min_value = params.get('fee') or params.get('fee_per_kb') or config.DEFAULT_FEE_PER_KB
+    min_value += 2 * (params.get('regular_dust_size') or config.DEFAULT_REGULAR_DUST_SIZE)
+    if method == 'create_send' and params.get('asset') == config.BTC:
+        min_value += params.get('quantity') or 0
+    return min_value
+
+# Outputs worth at least `min_value` satoshis, or all of them if they are not enough:
+# the smallest output covering `min_value` alone if there is one, the largest ones otherwise.
+def select_outputs(outputs, min_value):
+    outputs = sorted(outputs, key=lambda output: util.to_satoshis(output['amount']))
+    for output in outputs:
+        if util.to_satoshis(output['amount']) >= min_value:
+            return [output]
+    selected, total = [], 0
+    for output in reversed(outputs):
+        selected.append(output)
+        total += util.to_satoshis(output['amount'])
+        if total >= min_value:
+            break
+    return selected
+
+class UTXOAllocator:
+    """
+        Hands out disjoint sets of wallet unspent outputs to concurrent composes.
+
+        Outputs handed out are reserved until the transaction spending them is
+        broadcast (`broadcasted`), they are released (`release`), or `ttl`
+        seconds have passed. With `chain_change`, the change outputs of broadcast
+        transactions go back into the pool, so that the next transactions can
+        spend them before they are confirmed.
+    """
+
+    def __init__(self, list_unspent=None, ttl=DEFAULT_RESERVATION_TTL, chain_change=False):
+        self.list_unspent_func = list_unspent or wallet.list_unspent
+        self.ttl = ttl
+        self.chain_change = chain_change
+        self.lock = threading.Lock()
+        self.reserved = {}      # outpoint -> (expiry, output)
+        self.spent = {}         # outpoint -> expiry; hidden until the wallet forgets them
+        self.chained = collections.OrderedDict()    # outpoint -> output
+
+    def expire(self):
+        # Must be called with the lock held.
+        now = time.time()
+        for key, (expiry, output) in list(self.reserved.items()):
+            if expiry <= now:
+                del self.reserved[key]
+        for key, expiry in list(self.spent.items()):
+            if expiry <= now:
+                del self.spent[key]
+
+    def available(self, source):
+        # Must be called with the lock held.
+        outputs = collections.OrderedDict()
+        for output in self.list_unspent_func():
+            if output['address'] == source:
+                outputs[outpoint(output)] = output
+            # Once the wallet lists a chained output, it doesn't need to be tracked anymore.
+            self.chained.pop(outpoint(output), None)
+        for key, output in self.chained.items():
+            if output['address'] == source:
+                outputs.setdefault(key, output)
+        return [output for key, output in outputs.items() if key not in self.reserved and key not in self.spent]
+
+    def reserve(self, source, min_value):
+        """
+            Reserve unspent outputs of `source` worth at least `min_value` satoshis
+            (see `select_outputs`).
+        """
+        with self.lock:
+            self.expire()
+            selected = select_outputs(self.available(source), min_value)
+            if not selected:
+                raise UTXOAllocationError('No unreserved unspent outputs for {}.'.format(source))
+
+            expiry = time.time() + self.ttl
+            for output in selected:
+                self.reserved[outpoint(output)] = (expiry, output)
+            return selected
+
+    def release(self, outpoints):
+        with self.lock:
+            for key in outpoints:
+                self.reserved.pop(key, None)
+
+    def broadcasted(self, signed_tx_hex):
+        """
+            Record a transaction built from reserved outputs as broadcast: its
+            inputs stay unavailable, and with `chain_change` its outputs paying
+            back to an input address become available.
+        """
+        ctx = parse_transaction(signed_tx_hex)
+        txid = ib2h(ctx.GetTxid())
+        with self.lock:
+            scripts = {}
+            expiry = time.time() + self.ttl
+            for key in transaction_outpoints(ctx):
+                reservation = self.reserved.pop(key, None)
+                output = reservation[1] if reservation else self.chained.pop(key, None)
+                if output is not None and 'scriptPubKey' in output:
+                    scripts[output['scriptPubKey']] = output['address']
+                self.spent[key] = expiry
+
+            if self.chain_change:
+                for vout, tx_out in enumerate(ctx.vout):
+                    script_pubkey = binascii.hexlify(tx_out.scriptPubKey).decode('ascii')
+                    if script_pubkey in scripts:
+                        self.chained[(txid, vout)] = {
+                            'txid': txid,
+                            'vout': vout,
+                            'address': scripts[script_pubkey],
+                            'scriptPubKey': script_pubkey,
+                            'amount': tx_out.nValue / config.UNIT,
+                            'confirmations': 0
+                        }
+        return txid
+
+    def compose(self, method, params):
+        """
+            Call `method` with inputs reserved for `params['source']`. When the server
+            finds them insufficient, retry with twice the value, until no more outputs
+            are available. Reserved outputs the transaction doesn't spend are released.
+        """
+        params = dict(params, disable_utxo_locks=True)
+        min_value = estimate_min_value(method, params)
+        for i in range(MAX_COMPOSE_TRIES):
+            inputs = self.reserve(params['source'], min_value)
+            inputs_value = sum(util.to_satoshis(output['amount']) for output in inputs)
+            params['custom_inputs'] = inputs
+            try:
+                unsigned_tx_hex = util.api(method, params)
+            except util.RPCError as e:
+                self.release([outpoint(output) for output in inputs])
+                if is_insufficient_error(e) and inputs_value >= min_value:
+                    logger.debug('Inputs worth {} insufficient for {}; retrying.'.format(inputs_value, method))
+                    min_value = inputs_value * 2
+                    continue
+                raise
+
+            spent = set(transaction_outpoints(parse_transaction(unsigned_tx_hex)))
+            self.release([outpoint(output) for output in inputs if outpoint(output) not in spent])
+            return unsigned_tx_hex
+
+        raise UTXOAllocationError('Could not find sufficient inputs for {} after {} tries.'.format(method, MAX_COMPOSE_TRIES))
+
+    def stats(self):
+        with self.lock:
+            return {'reserved': len(self.reserved), 'spent': len(self.spent), 'chained': len(self.chained)}
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -6,15 +6,20 @@ logger = logging.getLogger(__name__)
 import sys
 import json
 import time
+import collections
+import functools
+import concurrent.futures
 from decimal import Decimal as D
 
 from unopartycli.wallet import unobtaniumcore, btcwallet
+from unopartycli import signing
 from unopartylib.lib import config, util, exceptions, script
-from unopartycli.util import api, value_out
+from unopartycli.util import api, api_rows, validate_address, value_out, get_divisibilities, chunks, to_satoshis, SQLITE_MAX_VARIABLES, DEFAULT_RPC_POOL_SIZE
 
-from pycoin.tx import Tx, SIGHASH_ALL
-from pycoin.encoding import wif_to_tuple_of_secret_exponent_compressed, public_pair_to_hash160_sec
-from pycoin.ecdsa import generator_secp256k1, public_pair_for_secret_exponent
+# Addresses per `get_balances` query, leaving room for the bindings of the other filters.
+BALANCES_CHUNK_SIZE = SQLITE_MAX_VARIABLES - 9
+
+DEFAULT_UNLOCK_TIMEOUT = 60 # seconds
 
 class WalletError(Exception):
     pass
@@ -32,7 +37,7 @@ def get_btc_balances():
     for address, btc_balance in WALLET().get_btc_balances():
     	yield [address, btc_balance]
 
-def pycoin_sign_raw_transaction(tx_hex, private_key_wif):
+def get_key_material(private_key_wif):
     for char in private_key_wif:
         if char not in script.b58_digits:
             raise exceptions.TransactionError('invalid private key')
@@ -42,18 +47,60 @@ def pycoin_sign_raw_transaction(tx_hex, private_key_wif):
     else:
         allowable_wif_prefixes = [config.PRIVATEKEY_VERSION_MAINNET]
 
+    from pycoin.encoding import wif_to_tuple_of_secret_exponent_compressed, public_pair_to_hash160_sec
+    from pycoin.ecdsa import generator_secp256k1, public_pair_for_secret_exponent
     secret_exponent, compressed = wif_to_tuple_of_secret_exponent_compressed(
                     private_key_wif, allowable_wif_prefixes=allowable_wif_prefixes)
     public_pair = public_pair_for_secret_exponent(generator_secp256k1, secret_exponent)
     hash160 = public_pair_to_hash160_sec(public_pair, compressed)
-    hash160_lookup = {hash160: (secret_exponent, public_pair, compressed)}
-
+    return hash160, (secret_exponent, public_pair, compressed)
+
+# Decoded private keys of one signing call: WIF decoding and public key derivation are done
+# once per key, and the secret exponents are not kept once the call returns.
+def get_hash160_lookup(private_keys_wif):
+    hash160_lookup = {}
+    for private_key_wif in set(private_keys_wif):
+        hash160, key = get_key_material(private_key_wif)
+        hash160_lookup[hash160] = key
+    return hash160_lookup
+
+def pycoin_sign_with_lookup(tx_hex, hash160_lookup):
+    from pycoin.tx import Tx, SIGHASH_ALL
     tx = Tx.from_hex(tx_hex)
-    for idx, tx_in in enumerate(tx.txs_in):
-        tx.sign_tx_in(hash160_lookup, idx, tx_in.script, hash_type=SIGHASH_ALL)
-
+    for idx in range(len(tx.txs_in)):
+        signing.sign_tx_in(tx, idx, hash160_lookup, SIGHASH_ALL)
     return tx.as_hex()
 
+def pycoin_sign_transactions(hash160_lookup, tx_hexes):
+    return [pycoin_sign_with_lookup(tx_hex, hash160_lookup) for tx_hex in tx_hexes]
+
+def pycoin_sign_raw_transaction(tx_hex, private_key_wif):
+    return pycoin_sign_with_lookup(tx_hex, get_hash160_lookup([private_key_wif]))
+
+def sign_raw_transactions(tx_hexes, keys, processes=None):
+    """
+        Sign many transactions with a set of private keys (WIF), each input
+        being signed by the key matching its address.
+        The work is spread over `processes` worker processes (default: one per CPU);
+        signed transactions are returned in the same order as `tx_hexes`.
+    """
+    tx_hexes = list(tx_hexes)
+    hash160_lookup = get_hash160_lookup(keys)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(tx_hexes))
+    if processes <= 1:
+        return pycoin_sign_transactions(hash160_lookup, tx_hexes)
+
+    # A few chunks per process, so that the key lookup is pickled only once per chunk.
+    chunk_size = max(1, -(-len(tx_hexes) // (processes * 4)))
+    signed_tx_hexes = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        sign_chunk = functools.partial(pycoin_sign_transactions, hash160_lookup)
+        for signed_chunk in executor.map(sign_chunk, chunks(tx_hexes, chunk_size)):
+            signed_tx_hexes += signed_chunk
+    return signed_tx_hexes
+
 def sign_raw_transaction(tx_hex, private_key_wif=None):
     if private_key_wif is None:
         if WALLET().is_locked():
@@ -66,7 +113,14 @@ def get_pubkey(address):
     return WALLET().get_pubkey(address)
 
 def is_valid(address):
-    return WALLET().is_valid(address)
+    valid = validate_address(address)
+    if valid is None:
+        return WALLET().is_valid(address)
+    return valid
+
+# Fetch the wallet informations of several addresses in one request.
+def prefetch_addresses_info(addresses):
+    WALLET().get_addresses_info(addresses)
 
 def is_mine(address):
     return WALLET().is_mine(address)
@@ -77,43 +131,106 @@ def get_btc_balance(address):
 def list_unspent():
     return WALLET().list_unspent()
 
+def get_output_amounts(outpoints):
+    return WALLET().get_output_amounts(outpoints)
+
 def send_raw_transaction(tx_hex):
 	return WALLET().send_raw_transaction(tx_hex)
 
+# Broadcast several transactions in one request; a rejected one yields an `RPCError` in its slot.
+def send_raw_transactions(tx_hexes):
+    return WALLET().send_raw_transactions(tx_hexes)
+
+# Sign several transactions with the wallet keys in one request (the wallet must be unlocked);
+# a failed one yields an `RPCError` in its slot.
+def wallet_sign_raw_transactions(tx_hexes):
+    return WALLET().sign_raw_transactions(tx_hexes)
+
 def is_locked():
     return WALLET().is_locked()
 
-def unlock(passphrase):
-    return WALLET().unlock(passphrase)
+def unlock(passphrase, timeout=DEFAULT_UNLOCK_TIMEOUT):
+    return WALLET().unlock(passphrase, timeout=timeout)
 
 def wallet_last_block():
     return WALLET().wallet_last_block()
 
+# Fetch the balances of many addresses with chunked `IN` queries, run concurrently.
+def get_balances(addresses, asset=None):
+    def get_chunk_balances(chunk):
+        filters = [('address', 'IN', chunk)]
+        if asset is not None:
+            filters.append(('asset', '==', asset))
+        return list(api_rows('get_balances', {'filters': filters}))
+
+    address_chunks = list(chunks(addresses, BALANCES_CHUNK_SIZE))
+    if len(address_chunks) <= 1:
+        return [balance for chunk in address_chunks for balance in get_chunk_balances(chunk)]
+
+    max_workers = min(len(address_chunks), getattr(config, 'RPC_POOL_SIZE', DEFAULT_RPC_POOL_SIZE))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [balance for chunk_balances in executor.map(get_chunk_balances, address_chunks) for balance in chunk_balances]
+
+# Iterate over the valid sends of `asset_name` from or to `addresses`, one page at a time.
+def get_sends(addresses, asset_name):
+    address_set = set(addresses)
+    for field in ['source', 'destination']:
+        for chunk in chunks(addresses, BALANCES_CHUNK_SIZE):
+            filters = [(field, 'IN', chunk), ('asset', '==', asset_name)]
+            for send in api_rows('get_sends', {'filters': filters, 'status': 'valid'}):
+                # In-wallet sends were already returned by the `source` queries.
+                if field == 'destination' and send['source'] in address_set:
+                    continue
+                yield send
+
+# Quantities in base units, converted to the result types: floats (like the wallet amounts) for UNO, `Decimal` for assets.
+def quantity_out(quantity, asset, divisible=None):
+    if asset == 'UNO':
+        return quantity / config.UNIT
+    return D(value_out(quantity, asset, divisible=divisible))
+
 def wallet():
-    wallet = {
-        'addresses': {},
-        'assets': {}
-    }
+    # Totals are accumulated in base units and converted only at the end.
+    address_totals = collections.OrderedDict()
+    asset_totals = collections.OrderedDict()
 
     def add_total(address, asset, quantity):
         if quantity:
-            if address not in wallet['addresses']:
-                wallet['addresses'][address] = {}
-            if asset not in wallet['assets']:
-                wallet['assets'][asset]  = 0
-            if asset not in wallet['addresses'][address]:
-                wallet['addresses'][address][asset] = 0
-            wallet['addresses'][address][asset] += quantity
-            wallet['assets'][asset]  += quantity
+            if address not in address_totals:
+                address_totals[address] = collections.OrderedDict()
+            if asset not in asset_totals:
+                asset_totals[asset] = 0
+            if asset not in address_totals[address]:
+                address_totals[address][asset] = 0
+            address_totals[address][asset] += quantity
+            asset_totals[asset] += quantity
+
+    btc_balances = list(get_btc_balances())
+    addresses = [address for address, btc_balance in btc_balances]
+
+    balances_by_address = collections.defaultdict(list)
+    for balance in get_balances(addresses):
+        balances_by_address[balance['address']].append(balance)
+
+    for address, btc_balance in btc_balances:
+        add_total(address, 'UNO', to_satoshis(btc_balance))
+        for balance in balances_by_address[address]:
+            add_total(address, balance['asset'], balance['quantity'])
+
+    divisibilities = get_divisibilities(asset_totals.keys())
+    def to_value(quantity, asset):
+        return quantity_out(quantity, asset, divisible=divisibilities[asset])
 
-    for bunch in get_btc_balances():
-        address, btc_balance = bunch
-        add_total(address, 'UNO', btc_balance)
-        balances = api('get_balances', {'filters': [('address', '==', address),]})
-        for balance in balances:
-            asset = balance['asset']
-            balance = D(value_out(balance['quantity'], asset))
-            add_total(address, asset, balance)
+    wallet = {
+        'addresses': {},
+        'assets': {}
+    }
+    for address in address_totals:
+        wallet['addresses'][address] = {}
+        for asset in address_totals[address]:
+            wallet['addresses'][address][asset] = to_value(address_totals[address][asset], asset)
+    for asset in asset_totals:
+        wallet['assets'][asset] = to_value(asset_totals[asset], asset)
 
     return wallet
 
@@ -155,40 +272,44 @@ def asset(asset_name):
             'issuer': issuance['issuer']
         })
 
-    asset_info['balance'] = 0
-    asset_info['addresses'] = {}
+    divisible = asset_info['divisible']
+    def to_value(quantity):
+        return quantity_out(quantity, asset_name, divisible=divisible)
 
-    for bunch in get_btc_balances():
-        address, btc_balance = bunch
-        if asset_name == 'UNO':
-            balance = btc_balance
-        else:
-            balances = api('get_balances', {'filters': [('address', '==', address), ('asset', '==', asset_name)]})
-            if balances:
-                balance = balances[0]
-                balance = D(value_out(balance['quantity'], asset_name))
-            else:
-                balance = 0
-        if balance:
-            asset_info['balance'] += balance
-            asset_info['addresses'][address] = balance
+    btc_balances = list(get_btc_balances())
+    if asset_name == 'UNO':
+        quantities = dict((address, to_satoshis(btc_balance)) for address, btc_balance in btc_balances)
+    else:
+        quantities = collections.defaultdict(int)
+        for balance in get_balances([address for address, btc_balance in btc_balances], asset=asset_name):
+            quantities[balance['address']] += balance['quantity']
+
+    # Sum in base units, keeping the wallet order of addresses.
+    total = 0
+    asset_info['addresses'] = {}
+    for address, btc_balance in btc_balances:
+        quantity = quantities.get(address, 0)
+        if quantity:
+            total += quantity
+            asset_info['addresses'][address] = to_value(quantity)
+    asset_info['balance'] = to_value(total) if total else 0
 
     addresses = list(asset_info['addresses'].keys())
 
     if asset_name != 'UNO':
-        all_sends = api('get_sends',  {'filters': [('source', 'IN', addresses), ('destination', 'IN', addresses)], 'filterop': 'OR', 'status': 'valid'})
+        address_set = set(addresses)
         sends = []
-        for send in all_sends:
-            if send['asset'] == asset_name:
-                if send['source'] in addresses and send['destination'] in addresses:
-                    tx_type = 'in-wallet'
-                elif send['source'] in addresses:
-                    tx_type = 'send'
-                elif send['destination'] in addresses:
-                    tx_type = 'receive'
-                send['type'] = tx_type
-                send['quantity'] = D(value_out(send['quantity'], asset_name))
-                sends.append(send)
+        for send in get_sends(addresses, asset_name):
+            if send['source'] in address_set and send['destination'] in address_set:
+                tx_type = 'in-wallet'
+            elif send['source'] in address_set:
+                tx_type = 'send'
+            else:
+                tx_type = 'receive'
+            send['type'] = tx_type
+            send['quantity'] = to_value(send['quantity'])
+            sends.append(send)
+        sends.sort(key=lambda send: send['tx_index'])
         asset_info['sends'] = sends
 
     return asset_info
@@ -198,9 +319,10 @@ def balances(address):
         'UNO': get_btc_balance(address)
     }
     balances = api('get_balances', {'filters': [('address', '==', address),]})
+    divisibilities = get_divisibilities([balance['asset'] for balance in balances])
     for balance in balances:
         asset = balance['asset']
-        balance = D(value_out(balance['quantity'], asset))
+        balance = D(value_out(balance['quantity'], asset, divisible=divisibilities[asset]))
         result[asset] =  balance
     return result
 
@@ -7,65 +7,87 @@ import time
 import requests
 
 from unopartylib.lib import config
-from unopartycli.util import wallet_api as rpc
+from unopartycli.util import wallet_api as rpc, wallet_api_batch as rpc_batch, UTXOSnapshot, RPCError, to_satoshis, address_info_cache
+
+# `validateaddress` results may change with the wallet: they are dropped on new blocks.
+utxo_snapshot = UTXOSnapshot(lambda: rpc('listunspent', [0, 99999]), lambda: wallet_last_block(), on_reload=address_info_cache.clear)
+
+def get_address_info(address):
+    return address_info_cache.get([address])[0]
+
+def get_addresses_info(addresses):
+    return address_info_cache.get(addresses)
 
 def get_wallet_addresses():
-    addresses = []
-    for output in rpc('listunspent', [0, 99999]):
-        if output['address'] not in addresses:
-            addresses.append(output['address'])
-    return addresses
+    return utxo_snapshot.addresses()
 
 def get_btc_balances():
-    addresses = {}
-    for output in rpc('listunspent', [0, 99999]):
-        if output['address'] not in addresses:
-            addresses[output['address']] = 0
-        addresses[output['address']] += output['amount']
-
-    for address in addresses:
-        yield [address, addresses[address]]
+    for address, btc_balance in utxo_snapshot.balances():
+        yield [address, btc_balance]
 
 def list_unspent():
-    return rpc('listunspent', [0, 99999])
+    return utxo_snapshot.list_unspent()
+
+def get_output_amounts(outpoints):
+    amounts = utxo_snapshot.get_output_amounts(outpoints)
+    # Only fetch the outpoints that are not already indexed.
+    missing = [outpoint for outpoint in outpoints if outpoint not in amounts]
+    results = rpc_batch([('gettxout', [txid, vout, True]) for txid, vout in missing], return_errors=True)
+    for outpoint, tx_out in zip(missing, results):
+        if tx_out and not isinstance(tx_out, RPCError):
+            amounts[outpoint] = to_satoshis(tx_out['value'])
+    return amounts
 
 def sign_raw_transaction(tx_hex):
     return rpc('signrawtransaction', [tx_hex])['hex']
 
+def sign_raw_transactions(tx_hexes):
+    results = rpc_batch([('signrawtransaction', [tx_hex]) for tx_hex in tx_hexes], return_errors=True)
+    signed_tx_hexes = []
+    for result in results:
+        if not isinstance(result, RPCError) and not result.get('complete', True):
+            result = RPCError('Transaction not fully signed.')
+        signed_tx_hexes.append(result if isinstance(result, RPCError) else result['hex'])
+    return signed_tx_hexes
+
 def is_valid(address):
-    address_info = rpc('validateaddress', [address])
+    address_info = get_address_info(address)
     # btcwallet return valid for pubkey
     if address_info['isvalid'] and address_info['address'] == address:
         return True
     return False
 
 def is_mine(address):
-    address_info = rpc('validateaddress', [address])
+    address_info = get_address_info(address)
     if 'ismine' not in address_info:
         return False
     return address_info['ismine']
 
 def get_pubkey(address):
-    address_infos = rpc('validateaddress', [address])
+    address_infos = get_address_info(address)
     if address_infos['isvalid'] and address_infos['ismine']:
         return address_infos['pubkey']
     return None
 
 def get_btc_balance(address):
-    balance = 0
-    for output in rpc('listunspent', [0, 99999]):
-        if output['address'] == address:
-            balance += output['amount']
-    return balance
+    return utxo_snapshot.balance(address)
 
 def is_locked():
     return rpc('walletislocked', [])
 
-def unlock(passphrase):
-    return rpc('walletpassphrase', [passphrase, 60])
+def unlock(passphrase, timeout=60):
+    return rpc('walletpassphrase', [passphrase, timeout])
 
 def send_raw_transaction(tx_hex):
-    return rpc('sendrawtransaction', [tx_hex])
+    tx_hash = rpc('sendrawtransaction', [tx_hex])
+    utxo_snapshot.invalidate()
+    return tx_hash
+
+# Broadcast several transactions in one request; a rejected one yields an `RPCError`.
+def send_raw_transactions(tx_hexes):
+    tx_hashes = rpc_batch([('sendrawtransaction', [tx_hex]) for tx_hex in tx_hexes], return_errors=True)
+    utxo_snapshot.invalidate()
+    return tx_hashes
 
 def wallet_last_block():
     getinfo = rpc('getinfo', [])